@@ -0,0 +1,284 @@
+#! /usr/gapps/spot/venv_python/bin/python3
+
+# benchmarks for the spot.py entry points on synthetic datasets.
+#
+#   spot-benchmark.py generate <dir> --runs 1000 --depth 4 --width 4
+#   spot-benchmark.py run <dir> --report report.json
+#   spot-benchmark.py compare before.json after.json
+#
+# `generate` writes <dir>/cali/*.cali and <dir>/runs.sqlite. `run` times every
+# case in a fresh process (so peak RSS is per case) and writes a json report.
+# Everything runs offline: .cali files are read by spot's native reader or,
+# for the cali-query cases, by a stub cali-query that wraps the native reader.
+
+import argparse, json, sys, os, platform, subprocess, random, resource, shutil, tempfile, time
+
+SPOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# metric attributes: double, asvalue | skip_events
+_METRIC_PROP = 65
+# region attributes: string, nested | process scope
+_REGION_PROP = 268
+# adiak globals: global | process scope
+_GLOBAL_PROP = 524
+
+_ADIAK_TYPES = [('string', 3), ('int', 1), ('double', 5), ('date', 2)]
+_COMMITS = ['{:07x}'.format(random.Random(i).getrandbits(28)) for i in range(20)]
+
+
+def _regionPaths(depth, width):
+    # call paths of a tree of the given depth with `width` children per node, parents first
+    paths = [('main',)]
+    level = [('main',)]
+    for d in range(1, depth):
+        level = [path + ('region_{}_{}'.format(d, i),) for path in level for i in range(width)]
+        paths.extend(level)
+    return paths
+
+def _runGlobals(rng, runIdx, nglobals):
+    # [(name, adiak type, value)]
+    globals_ = [ ('launchdate', 'date', 1600000000 + 3600 * runIdx)
+               , ('commit', 'string', rng.choice(_COMMITS))
+               , ('problem_size', 'int', rng.choice([30, 45, 60, 90]))
+               , ('figure_of_merit', 'double', round(rng.uniform(500, 1500), 6))
+               ]
+    for i in range(nglobals):
+        globals_.append(('global_{}'.format(i), 'string', 'value_{}'.format(rng.randrange(8))))
+    return globals_
+
+def _runRecords(rng, paths, metrics):
+    records = []
+    for path in paths:
+        record = {metric: round(rng.uniform(0.001, 10.0) / len(path), 6) for metric in metrics}
+        record['path'] = '/'.join(path)
+        records.append(record)
+    return records
+
+def _writeCali(filepath, paths, metrics, globals_, records):
+    lines = []
+    ids = iter(range(11, 1 << 30))
+
+    def node(attr, data, parent=None):
+        nodeId = next(ids)
+        data = str(data).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=')
+        lines.append('__rec=node,id={},attr={},data={}'.format(nodeId, attr, data) + ('' if parent is None else ',parent={}'.format(parent)))
+        return nodeId
+
+    metricProp = node(10, _METRIC_PROP, 5)
+    metricIds = [node(8, metric, metricProp) for metric in metrics]
+    regionAttr = node(8, 'function', node(10, _REGION_PROP, 3))
+
+    adiakProp = node(10, 12, 3)
+    categoryAttr = node(8, 'adiak.category', adiakProp)
+    typeAttr = node(8, 'adiak.type', adiakProp)
+    globalProps = {adiakType: node(10, _GLOBAL_PROP, node(categoryAttr, 'general', node(typeAttr, adiakType, caliType)))
+                   for (adiakType, caliType) in _ADIAK_TYPES}
+
+    regionIds = {}
+    for (path, record) in zip(paths, records):
+        regionIds[path] = node(regionAttr, path[-1], regionIds.get(path[:-1]))
+        lines.append('__rec=ctx,ref={},attr={},data={}'.format(regionIds[path], '='.join(map(str, metricIds)),
+                                                             '='.join(str(record[metric]) for metric in metrics)))
+
+    valueNode = None
+    for (name, adiakType, value) in globals_:
+        valueNode = node(node(8, name, globalProps[adiakType]), value, valueNode)
+    lines.append('__rec=globals,ref={}'.format(valueNode))
+
+    with open(filepath, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def generate(args):
+    rng = random.Random(args.seed)
+    caliDir = os.path.join(args.directory, 'cali')
+    os.makedirs(caliDir, exist_ok=True)
+    dbPath = os.path.join(args.directory, 'runs.sqlite')
+    if os.path.exists(dbPath):
+        os.remove(dbPath)
+
+    import sqlite3
+    db = sqlite3.connect(dbPath)
+    db.execute('CREATE TABLE Runs (run INTEGER PRIMARY KEY, globals TEXT, records TEXT)')
+    db.execute('CREATE TABLE Metadata (name TEXT, datatype TEXT)')
+
+    paths = _regionPaths(args.depth, args.width)
+    metrics = ['{}#inclusive#sum#metric_{}'.format(('avg', 'min', 'max')[i % 3], i) for i in range(args.metrics)]
+    for runIdx in range(args.runs):
+        globals_ = _runGlobals(rng, runIdx, args.globals)
+        records = _runRecords(rng, paths, metrics)
+        _writeCali(os.path.join(caliDir, 'run-{:07d}.cali'.format(runIdx)), paths, metrics, globals_, records)
+        db.execute('INSERT INTO Runs VALUES (?, ?, ?)', (runIdx + 1, json.dumps({name: value for (name, _, value) in globals_}), json.dumps(records)))
+    db.executemany('INSERT INTO Metadata VALUES (?, ?)', [(name, adiakType) for (name, adiakType, _) in _runGlobals(rng, 0, args.globals)])
+    db.commit()
+
+    print(json.dumps({ 'directory': args.directory
+                     , 'runs': args.runs
+                     , 'paths': len(paths)
+                     , 'metrics': len(metrics)
+                     , 'globals': args.globals + 4
+                     }))
+
+
+# cases.  Each case is (name, entry point, cache state, workers, reader)
+
+_CASES = [ ('getData-dir-cold-serial', 'getData-dir', 'cold', 1, 'native')
+         , ('getData-dir-cold-parallel', 'getData-dir', 'cold', 0, 'native')
+         , ('getData-dir-warm', 'getData-dir', 'warm', 0, 'native')
+         , ('getData-dir-caliquery-parallel', 'getData-dir', 'cold', 0, 'stub')
+         , ('getRun-dir-cold', 'getRun-dir', 'cold', 1, 'native')
+         , ('getRun-dir-warm', 'getRun-dir', 'warm', 1, 'native')
+         , ('getHatchetLiteral-dir', 'getHatchetLiteral-dir', 'cold', 1, 'native')
+         , ('getData-sqlite', 'getData-sqlite', 'cold', 1, 'native')
+         , ('getRun-sqlite', 'getRun-sqlite', 'cold', 1, 'native')
+         , ('getHatchetLiteral-sqlite', 'getHatchetLiteral-sqlite', 'cold', 1, 'native')
+         ]
+
+class _CountingWriter:
+    # swallows output, counting its size
+    def __init__(self):
+        self.bytes = 0
+    def write(self, s):
+        self.bytes += len(s)
+    def flush(self):
+        pass
+
+_STUB_CALIQUERY = """#! {python}
+# stub cali-query: answers 'format json(object) [where a=b]' with spot's native reader
+import json, sys
+sys.path.insert(0, {spotDir!r})
+import spot
+query = sys.argv[sys.argv.index('-q') + 1]
+where = tuple(query.split(' where ', 1)[1].split('=', 1)) if ' where ' in query else None
+json.dump(spot._read_cali(sys.argv[-1], where), sys.stdout)
+"""
+
+def _runCase(args):
+    # runs in its own process, prints the measurements as json
+    sys.path.insert(0, SPOT_DIR)
+    import spot
+
+    (name, entry, cache, workers, reader) = [c for c in _CASES if c[0] == args.case][0]
+    caliDir = os.path.join(args.directory, 'cali')
+    dbPath = os.path.join(args.directory, 'runs.sqlite')
+    runs = len([f for f in os.listdir(caliDir) if f.endswith('.cali')])
+    firstCali = os.path.join(caliDir, sorted(os.listdir(caliDir))[0])
+
+    spot.CONFIG['run_cache'] = os.path.join(args.scratch, 'runs.sqlite')
+    spot.CONFIG['workers'] = workers
+    if reader == 'stub':
+        stub = os.path.join(args.scratch, 'cali-query')
+        with open(stub, 'w') as f:
+            f.write(_STUB_CALIQUERY.format(python=sys.executable, spotDir=SPOT_DIR))
+        os.chmod(stub, 0o755)
+        spot.CONFIG['native_reader'] = False
+        spot.CONFIG['caliquery'] = stub
+
+    out = _CountingWriter()
+    # through spot's own parser, so options added to getData get their defaults
+    getDataArgs = lambda key: spot._buildParser().parse_args(['getData', key, '{}'])
+    calls = { 'getData-dir': (lambda: spot.getData(getDataArgs(caliDir), out), runs)
+            , 'getRun-dir': (lambda: json.dump(spot.getRun(firstCali), out), 1)
+            , 'getHatchetLiteral-dir': (lambda: json.dump(spot.getHatchetLiteral(firstCali), out), 1)
+            , 'getData-sqlite': (lambda: spot.getData(getDataArgs(dbPath), out), runs)
+            , 'getRun-sqlite': (lambda: json.dump(spot.getRun(1, dbPath), out), 1)
+            , 'getHatchetLiteral-sqlite': (lambda: json.dump(spot.getHatchetLiteral(1, dbPath), out), 1)
+            }
+    (call, items) = calls[entry]
+
+    if cache == 'warm':
+        call()
+        out.bytes = 0
+    start = time.perf_counter()
+    call()
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on linux
+    selfRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    childRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(json.dumps({ 'seconds': elapsed
+                     , 'items': items
+                     , 'itemsPerSecond': items / elapsed if elapsed else None
+                     , 'outputBytes': out.bytes
+                     , 'peakRssKB': selfRss
+                     , 'peakChildRssKB': childRss
+                     , 'workers': spot._workerCount()
+                     }))
+
+def run(args):
+    cases = [c for c in _CASES if not args.cases or c[0] in args.cases.split(',')]
+    results = {}
+    for (name, entry, cache, workers, reader) in cases:
+        samples = []
+        for _ in range(args.repeat):
+            scratch = tempfile.mkdtemp(prefix='spot-benchmark-')
+            try:
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'case', name, args.directory, scratch])
+                samples.append(json.loads(output.decode('utf-8')))
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+        samples.sort(key=lambda sample: sample['seconds'])
+        results[name] = dict(samples[len(samples) // 2], minSeconds=samples[0]['seconds'], repeat=args.repeat)
+        print('{:36} {:9.3f} s  {:10.1f} items/s  {:8d} KB'.format(name, results[name]['seconds'], results[name]['itemsPerSecond'] or 0,
+                                                                 max(results[name]['peakRssKB'], results[name]['peakChildRssKB'])), file=sys.stderr)
+
+    try:
+        commit = subprocess.check_output(['git', '-C', SPOT_DIR, 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = { 'commit': commit
+             , 'date': time.time()
+             , 'host': platform.node()
+             , 'python': platform.python_version()
+             , 'dataset': os.path.abspath(args.directory)
+             , 'cases': results
+             }
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+
+def compare(args):
+    before = json.load(open(args.before))['cases']
+    after = json.load(open(args.after))['cases']
+    for name in before:
+        if name in after:
+            print('{:36} {:9.3f} s -> {:9.3f} s  ({:+.1f}%)'.format(name, before[name]['seconds'], after[name]['seconds'],
+                                                                  100.0 * (after[name]['seconds'] / before[name]['seconds'] - 1)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="benchmark spot.py on synthetic datasets")
+    subparsers = parser.add_subparsers(dest="sub_name")
+
+    generate_sub = subparsers.add_parser("generate")
+    generate_sub.add_argument("directory", help="where to write cali/ and runs.sqlite")
+    generate_sub.add_argument("--runs", type=int, default=1000)
+    generate_sub.add_argument("--depth", type=int, default=4, help="call tree depth")
+    generate_sub.add_argument("--width", type=int, default=4, help="children per call tree node")
+    generate_sub.add_argument("--metrics", type=int, default=3)
+    generate_sub.add_argument("--globals", type=int, default=10, help="extra string globals per run")
+    generate_sub.add_argument("--seed", type=int, default=0)
+    generate_sub.set_defaults(func=generate)
+
+    run_sub = subparsers.add_parser("run")
+    run_sub.add_argument("directory", help="dataset written by generate")
+    run_sub.add_argument("--cases", help="comma separated case names (default: all)")
+    run_sub.add_argument("--repeat", type=int, default=3)
+    run_sub.add_argument("--report", help="write the json report here instead of stdout")
+    run_sub.set_defaults(func=run)
+
+    compare_sub = subparsers.add_parser("compare")
+    compare_sub.add_argument("before", help="report of the baseline")
+    compare_sub.add_argument("after", help="report to compare against it")
+    compare_sub.set_defaults(func=compare)
+
+    case_sub = subparsers.add_parser("case")
+    case_sub.add_argument("case")
+    case_sub.add_argument("directory")
+    case_sub.add_argument("scratch")
+    case_sub.set_defaults(func=_runCase)
+
+    args = parser.parse_args()
+    args.func(args)
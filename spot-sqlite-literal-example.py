@@ -33,19 +33,21 @@ def getRun(runId, db=None):
     return output
 
 def getHatchetLiteral(runId, db=None):
-    funcPathDict = {line.pop('path'): line for line in getRun(runId, db)['records'] if line.get('path', None)}
+    # attach every path to the node of its parent path in a single pass
+    nodes = {}
+    for line in getRun(runId, db)['records']:
+        funcpath = line.get('path', None)
+        if funcpath:
+            nodes[funcpath] = { 'name': funcpath.rsplit('/', 1)[-1]
+                              , 'metrics': {k: v for (k, v) in line.items() if k != 'path'}
+                              }
 
-    def buildTree(nodeName):
-        node = {}
-        node['name'] = nodeName.split('/')[-1]
-        node['metrics'] = funcPathDict[nodeName]
-        childrenPaths = [childPath for childPath in funcPathDict.keys()
-                         if len(childPath.split('/')) == len(nodeName.split('/')) + 1 and childPath.startswith(nodeName)]
-        if childrenPaths:
-            node['children'] = [buildTree(childPath) for childPath in childrenPaths]
-        return node
+    for (funcpath, node) in nodes.items():
+        parent = nodes.get(funcpath.rpartition('/')[0])
+        if parent is not None:
+            parent.setdefault('children', []).append(node)
 
-    return [buildTree(min(funcPathDict.keys()))]
+    return [nodes[min(nodes.keys())]]
 
 lit = getHatchetLiteral(3, "/usr/gapps/spot/datasets/lulesh_new.sqlite")
 gf = ht.GraphFrame.from_literal(lit)
@@ -1,6 +1,6 @@
 #! /usr/gapps/spot/venv_python/bin/python3
 
-import argparse, json, sys, os, platform, subprocess, getpass, urllib.parse, socket, time
+import argparse, json, sys, os, platform, subprocess, getpass, urllib.parse, socket, time, threading, contextlib, re, functools, hashlib, zlib, io, itertools
 from datetime import datetime
 
 def get_deploy_dir():
@@ -27,28 +27,617 @@ CONFIG = { 'caliquery': cali_query_path + '/cali-query'
          , 'jupyter_host': ''
          , 'jupyter_use_token': True
          , 'jupyter_token': ''
+         , 'native_reader': True
+         , 'run_cache': os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'spot', 'runs.sqlite')
+         , 'run_cache_size': 1 << 30
+         , 'memory_cache_entries': 20000
+         , 'dir_snapshots': 100000
+         , 'append_only_datasets': False
+         , 'db_pool_size': 4
+         , 'db_fetch_size': 256
+         , 'workers': 0
+         , 'file_timeout': 300
+         , 'profile': False
+         , 'profile_log': None
+         , 'profile_cprofile': None
+         , 'profile_slowest': 20
+         , 'hatchet_sidecars': True
+         , 'hatchet_sidecar_dir': None
          }
 
+# set by the serve subcommand: keep pools, connections and parsed runs in memory
+_SERVING = False
+
+
+# opt-in profiling (--profile, or CONFIG['profile']): wall time, counts and bytes
+# per phase and per file of one command, written as a json line to stderr or
+# appended to CONFIG['profile_log']
+_PROFILE = threading.local()
+_CPROFILE_LOCK = threading.Lock()
+
+class _Profile:
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.files = []
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds=0.0, count=0, nbytes=0):
+        with self.lock:
+            stats = self.phases.setdefault(phase, {'seconds': 0.0, 'count': 0, 'bytes': 0})
+            stats['seconds'] += seconds
+            stats['count'] += count
+            stats['bytes'] += nbytes
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        # `with prof.phase('scan') as stats:` times the block; set stats['count'] and stats['bytes'] inside
+        stats = {'count': 0, 'bytes': 0}
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            self.add(phase, time.perf_counter() - start, stats['count'], stats['bytes'])
+
+    def addFile(self, path, stats):
+        with self.lock:
+            self.files.append(dict(stats, path=path))
+
+    def timed(self, phase, iterable):
+        # passes iterable through, charging the time spent producing each item to phase
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add(phase, time.perf_counter() - start)
+                return
+            self.add(phase, time.perf_counter() - start, 1)
+            yield item
+
+    def report(self):
+        slowest = sorted(self.files, key=lambda stats: stats['seconds'], reverse=True)[:CONFIG['profile_slowest']]
+        return { 'command': self.command
+               , 'seconds': time.perf_counter() - self.started
+               , 'phases': self.phases
+               , 'files': len(self.files)
+               , 'slowestFiles': slowest
+               }
+
+class _NoProfile(_Profile):
+
+    def add(self, phase, seconds=0.0, count=0, nbytes=0):
+        pass
+
+    def addFile(self, path, stats):
+        pass
+
+    def timed(self, phase, iterable):
+        return iterable
+
+_NO_PROFILE = _NoProfile(None)
+
+def _profile():
+    # the profile of the command running in this thread
+    return getattr(_PROFILE, 'current', _NO_PROFILE)
+
+class _CountingOutput:
+    # forwards writes to out and counts the characters written
+    def __init__(self, out):
+        self.out = out
+        self.bytes = 0
+
+    def write(self, s):
+        self.bytes += len(s)
+        return self.out.write(s)
+
+    def flush(self):
+        self.out.flush()
+
+def _runCommand(args, out=sys.stdout):
+    # run the subcommand, profiled if asked for
+    if not (args.profile or CONFIG['profile']):
+        return args.func(args, out)
+
+    prof = _PROFILE.current = _Profile(args.sub_name)
+    out = _CountingOutput(out)
+    cprofileDump = args.cprofile or CONFIG['profile_cprofile']
+    # only one cProfile profiler may be active at a time
+    profiler = None
+    if cprofileDump and _CPROFILE_LOCK.acquire(blocking=False):
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return args.func(args, out)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(cprofileDump)
+            _CPROFILE_LOCK.release()
+        del _PROFILE.current
+        report = prof.report()
+        report['outputBytes'] = out.bytes
+        line = json.dumps({'profile': report}) + '\n'
+        logPath = args.profile_log or CONFIG['profile_log']
+        if logPath:
+            with open(logPath, 'a') as f:
+                f.write(line)
+        else:
+            sys.stderr.write(line)
+
 
 def _sub_call(cmd):
     # call a subcommand in a new process and parse json results into object
     return json.loads(subprocess.check_output(cmd).decode('utf-8'))
 
+
+# in-process reader for the .cali text format.  Produces the same
+# {records, globals, attributes} structure as `cali-query -q 'format json(object)'`
+
+class CaliFormatError(Exception):
+    pass
+
+# caliper's bootstrap nodes: 0-7 are the type nodes, 8-10 the meta attributes
+_CALI_TYPES = ['usr', 'int', 'uint', 'string', 'addr', 'double', 'bool', 'type']
+_CALI_BOOTSTRAP_NODES = dict([(i, (9, name, None)) for (i, name) in enumerate(_CALI_TYPES)] +
+                             [ (8, (8, 'cali.attribute.name', 3))
+                             , (9, (8, 'cali.attribute.type', 7))
+                             , (10, (8, 'cali.attribute.prop', 1))
+                             ])
+_CALI_NAME_ATTR = 8
+_CALI_TYPE_ATTR = 9
+_CALI_PROP_ATTR = 10
+_CALI_PROP_HIDDEN = 128
+_CALI_PROP_NESTED = 256
+
+def _cali_unescape(s):
+    if '\\' not in s:
+        return s
+    out = []
+    escaped = False
+    for c in s:
+        if escaped or c != '\\':
+            out.append(c)
+            escaped = False
+        else:
+            escaped = True
+    return ''.join(out)
+
+def _cali_split(s, sep):
+    # split on unescaped separators, keeping escapes for _cali_unescape
+    if '\\' not in s:
+        return s.split(sep)
+    parts = []
+    start = 0
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == sep:
+            parts.append(s[start:i])
+            start = i + 1
+        i += 1
+    parts.append(s[start:])
+    return parts
+
+def _cali_lines(fileobj):
+    # an escaped newline continues the record on the next line
+    pending = ''
+    for line in fileobj:
+        line = pending + line.rstrip('\n')
+        stripped = line.rstrip('\\')
+        if (len(line) - len(stripped)) % 2 == 1:
+            pending = line[:-1] + '\n'
+            continue
+        pending = ''
+        if line:
+            yield line
+    if pending:
+        raise CaliFormatError('unterminated record')
+
+
+class _CaliReader:
+    # node-id -> attribute/parent resolution for a single .cali stream
+
+    def __init__(self):
+        self.nodes = dict(_CALI_BOOTSTRAP_NODES)
+        self.attrs = {}
+        self.refCache = {}
+
+    def attribute(self, attrId):
+        # returns (name, type, prop, metadata) for the attribute defined by node attrId
+        attr = self.attrs.get(attrId)
+        if attr is None:
+            try:
+                (nameAttr, name, parent) = self.nodes[attrId]
+            except KeyError:
+                raise CaliFormatError('unknown attribute id {}'.format(attrId))
+            if nameAttr != _CALI_NAME_ATTR:
+                raise CaliFormatError('node {} is not an attribute'.format(attrId))
+            meta = {}
+            while parent is not None:
+                (metaAttr, data, parent) = self.nodes[parent]
+                if metaAttr == _CALI_TYPE_ATTR:
+                    meta.setdefault('cali.attribute.type', data)
+                elif metaAttr == _CALI_PROP_ATTR:
+                    meta.setdefault('cali.attribute.prop', int(data))
+                else:
+                    meta.setdefault(self.attribute(metaAttr)[0], self.value(metaAttr, data))
+            attr = ( name
+                   , meta.get('cali.attribute.type', 'usr')
+                   , meta.get('cali.attribute.prop', 0)
+                   , meta
+                   )
+            self.attrs[attrId] = attr
+        return attr
+
+    def value(self, attrId, data):
+        if attrId == _CALI_TYPE_ATTR or attrId == _CALI_NAME_ATTR:
+            return data
+        type_ = self.attribute(attrId)[1]
+        try:
+            if type_ == 'double':
+                return float(data)
+            if type_ in ('int', 'uint'):
+                return int(data)
+            if type_ == 'bool':
+                return data in ('true', '1')
+        except ValueError:
+            raise CaliFormatError('bad {} value "{}"'.format(type_, data))
+        return data
+
+    def addNode(self, fields):
+        nodeId = attr = data = parent = None
+        for field in fields:
+            (key, _, val) = field.partition('=')
+            if key == 'id':
+                nodeId = int(val)
+            elif key == 'attr':
+                attr = int(val)
+            elif key == 'data':
+                data = _cali_unescape(val)
+            elif key == 'parent':
+                parent = int(val)
+        if nodeId is None or attr is None or data is None:
+            raise CaliFormatError('incomplete node record')
+        self.nodes[nodeId] = (attr, data, parent)
+
+    def refEntries(self, nodeId):
+        # (non-nested entries, nested path parts) along the path from nodeId to the root
+        cached = self.refCache.get(nodeId)
+        if cached is None:
+            entries = []
+            path = []
+            node = nodeId
+            while node is not None:
+                try:
+                    (attrId, data, parent) = self.nodes[node]
+                except KeyError:
+                    raise CaliFormatError('unknown node id {}'.format(node))
+                (name, _, prop, _) = self.attribute(attrId)
+                if not prop & _CALI_PROP_HIDDEN:
+                    if prop & _CALI_PROP_NESTED:
+                        path.append(data)
+                    else:
+                        entries.append((name, self.value(attrId, data)))
+                node = parent
+            path.reverse()
+            cached = (entries, path)
+            self.refCache[nodeId] = cached
+        return cached
+
+    def entryLists(self, fields):
+        refs = attrs = data = []
+        for field in fields:
+            (key, _, val) = field.partition('=')
+            if key == 'ref':
+                refs = [int(r) for r in val.split('=')]
+            elif key == 'attr':
+                attrs = [int(a) for a in val.split('=')]
+            elif key == 'data':
+                data = [_cali_unescape(d) for d in _cali_split(val, '=')]
+        if len(attrs) != len(data):
+            raise CaliFormatError('attr/data mismatch')
+        return (refs, attrs, data)
+
+    def record(self, fields):
+        (refs, attrs, data) = self.entryLists(fields)
+        rec = {}
+        path = []
+        for ref in refs:
+            (entries, parts) = self.refEntries(ref)
+            for (name, val) in entries:
+                rec.setdefault(name, val)
+            path.extend(parts)
+        for (attrId, val) in zip(attrs, data):
+            (name, _, prop, _) = self.attribute(attrId)
+            if not prop & _CALI_PROP_HIDDEN:
+                rec[name] = self.value(attrId, val)
+        if path:
+            rec['path'] = '/'.join(path)
+        return rec
+
+    def globals(self, fields):
+        (refs, attrs, data) = self.entryLists(fields)
+        out = {}
+        for ref in refs:
+            chain = []
+            node = ref
+            while node is not None:
+                (attrId, val, node) = self.nodes[node]
+                chain.append((attrId, val))
+            for (attrId, val) in reversed(chain):
+                out[self.attribute(attrId)[0]] = self.value(attrId, val)
+        for (attrId, val) in zip(attrs, data):
+            out[self.attribute(attrId)[0]] = self.value(attrId, val)
+        return out
+
+    def attributes(self):
+        out = {}
+        for (nodeId, (attr, _, _)) in self.nodes.items():
+            if attr == _CALI_NAME_ATTR and nodeId not in _CALI_BOOTSTRAP_NODES:
+                (name, _, _, meta) = self.attribute(nodeId)
+                out[name] = meta
+        return out
+
+
+def _iter_cali(filepath, reader, globals_, where=None, records=True):
+    # yields the ctx records of a .cali file as they are read, and collects
+    # its globals into globals_.
+    # `where` is an optional (attribute name, value) pair records must match;
+    # with records=False ctx records are skipped without being parsed
+    with open(filepath, encoding='utf-8', errors='replace') as f:
+        try:
+            for line in _cali_lines(f):
+                if not records and line.startswith('__rec=ctx'):
+                    continue
+                fields = _cali_split(line, ',')
+                kind = fields[0]
+                if kind == '__rec=ctx':
+                    rec = reader.record(fields[1:])
+                    if where is None or str(rec.get(where[0])) == where[1]:
+                        yield rec
+                elif kind == '__rec=node':
+                    reader.addNode(fields[1:])
+                elif kind == '__rec=globals':
+                    globals_.update(reader.globals(fields[1:]))
+                else:
+                    raise CaliFormatError('unsupported record "{}"'.format(kind))
+        except (KeyError, ValueError) as e:
+            raise CaliFormatError('{}: {!r}'.format(filepath, e))
+
+def _read_cali(filepath, where=None):
+    reader = _CaliReader()
+    globals_ = {}
+    records = list(_iter_cali(filepath, reader, globals_, where))
+    return {'records': records, 'globals': globals_, 'attributes': reader.attributes()}
+
+def _read_cali_globals(filepath):
+    # _read_cali without the records
+    reader = _CaliReader()
+    globals_ = {}
+    for _ in _iter_cali(filepath, reader, globals_, records=False):
+        pass
+    return {'records': [], 'globals': globals_, 'attributes': reader.attributes()}
+
+def _read_cali_first_record(filepath):
+    # only reads up to the first ctx record
+    records = _iter_cali(filepath, _CaliReader(), {})
+    try:
+        return next(records, None)
+    finally:
+        records.close()
+
+
+def _cali_query(filepath, where=None):
+    query = 'format json(object)'
+    if where:
+        query += ' where {}={}'.format(*where)
+    return _sub_call([CONFIG['caliquery'] , '-q', query, filepath])
+
+def _cali_read(filepath, where=None):
+    # native reader first, cali-query for anything it can't handle
+    if CONFIG['native_reader']:
+        try:
+            return _read_cali(filepath, where)
+        except CaliFormatError:
+            pass
+    return _cali_query(filepath, where)
+
 def _cali_to_json(filepath):
 
-    cali_json = _sub_call([CONFIG['caliquery'] , '-q', 'format json(object)', filepath])
+    cali_json = _cali_read(filepath)
+    return cali_json
+
+def _cali_globals_to_json(filepath):
+    if CONFIG['native_reader']:
+        try:
+            return _read_cali_globals(filepath)
+        except CaliFormatError:
+            pass
+    cali_json = _cali_query(filepath)
+    cali_json['records'] = []
     return cali_json
 
 def _cali_timeseries_to_json(filepath):
-    
-    query = 'format json(object) where spot.channel=timeseries'
-    cali_json = _sub_call([CONFIG['caliquery'] , '-q', query, filepath])
+
+    cali_json = _cali_read(filepath, ('spot.channel', 'timeseries'))
     return cali_json
 
 
-def defaultKey(filepath):
+# persistent cache of parsed runs, keyed by (path, st_size, st_ctime).  Entries
+# are evicted least-recently-used once the payloads exceed CONFIG['run_cache_size']
+
+_RUN_CACHE = None
+_RUN_CACHE_LOCK = threading.RLock()
+_MEMORY_CACHE = None
+
+def _memoryCache():
+    # in-process LRU in front of the sqlite cache, only kept by the server.
+    # values are shared between requests and must not be modified
+    global _MEMORY_CACHE
+    if _MEMORY_CACHE is None and _SERVING:
+        import collections
+        _MEMORY_CACHE = collections.OrderedDict()
+    return _MEMORY_CACHE
+
+_NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'lustre', 'gpfs', 'afs', 'ceph', 'glusterfs', 'beegfs', 'fuse.sshfs', '9p')
 
-    records = _cali_to_json(filepath)['records']
+def _isNetworkFilesystem(filepath):
+    # by the type of the longest mount point containing filepath, from /proc/mounts
+    path = os.path.realpath(os.path.dirname(os.path.abspath(filepath)))
+    (mountPoint, fsType) = ('', None)
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) > len(mountPoint):
+                    (mountPoint, fsType) = (mount, fields[2])
+    except OSError:
+        return False
+    return fsType in _NETWORK_FILESYSTEMS
+
+def _runCache():
+    global _RUN_CACHE
+    if _RUN_CACHE is None:
+        _RUN_CACHE = False
+        if CONFIG['run_cache']:
+            import sqlite3
+            try:
+                os.makedirs(os.path.dirname(CONFIG['run_cache']), exist_ok=True)
+                db = sqlite3.connect(CONFIG['run_cache'], timeout=30, isolation_level=None, check_same_thread=False)
+                # WAL needs shared memory between the processes using the file, which
+                # network filesystems (e.g. NFS home directories) do not provide
+                if _isNetworkFilesystem(CONFIG['run_cache']):
+                    db.execute('PRAGMA journal_mode=DELETE')
+                else:
+                    db.execute('PRAGMA journal_mode=WAL')
+                    db.execute('PRAGMA synchronous=NORMAL')
+                db.execute('CREATE TABLE IF NOT EXISTS RunCache'
+                           ' ( path TEXT, kind TEXT, size INTEGER, ctime REAL, atime REAL, nbytes INTEGER, payload BLOB'
+                           ' , PRIMARY KEY (path, kind))')
+                db.execute('CREATE INDEX IF NOT EXISTS RunCacheAtime ON RunCache (atime)')
+                db.execute('CREATE TABLE IF NOT EXISTS Manifests'
+                           ' ( dataset TEXT, dir TEXT, mtime REAL, entries TEXT'
+                           ' , PRIMARY KEY (dataset, dir))')
+                db.execute('CREATE TABLE IF NOT EXISTS DirSnapshots'
+                           ' ( digest TEXT PRIMARY KEY, files TEXT, atime REAL)')
+                _RUN_CACHE = db
+            except (sqlite3.Error, OSError):
+                pass
+    return _RUN_CACHE
+
+def _cacheKey(filepath, st=None):
+    st = st or os.stat(filepath)
+    return (os.path.abspath(filepath), st.st_size, st.st_ctime)
+
+def _cacheGetMany(kind, keys):
+    # returns {key: value} for the keys with an up-to-date entry
+    import sqlite3, zlib
+    hits = {}
+    with _RUN_CACHE_LOCK:
+        mem = _memoryCache()
+        if mem is not None:
+            for key in keys:
+                if (kind, key) in mem:
+                    mem.move_to_end((kind, key))
+                    hits[key] = mem[(kind, key)]
+        db = _runCache()
+        if not db or len(hits) == len(keys):
+            return hits
+        found = {}
+        try:
+            db.execute('BEGIN')
+            for key in keys:
+                if key in hits:
+                    continue
+                row = db.execute('SELECT size, ctime, payload FROM RunCache WHERE path = ? AND kind = ?', (key[0], kind)).fetchone()
+                if row and (row[0], row[1]) == key[1:]:
+                    found[key] = json.loads(zlib.decompress(row[2]).decode('utf-8'))
+            now = time.time()
+            db.executemany('UPDATE RunCache SET atime = ? WHERE path = ? AND kind = ?', [(now, key[0], kind) for key in found])
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            return hits
+        _memoryPut(kind, found.items())
+    hits.update(found)
+    return hits
+
+def _memoryPut(kind, items):
+    mem = _memoryCache()
+    if mem is not None:
+        for (key, value) in items:
+            mem[(kind, key)] = value
+            mem.move_to_end((kind, key))
+        while len(mem) > CONFIG['memory_cache_entries']:
+            mem.popitem(last=False)
+
+def _cachePutMany(kind, items):
+    # items: [(key, value)]
+    import sqlite3, zlib
+    with _RUN_CACHE_LOCK:
+        _memoryPut(kind, items)
+        db = _runCache()
+        if not db or not items:
+            return
+        now = time.time()
+        rows = []
+        for ((path, size, ctime), value) in items:
+            payload = zlib.compress(json.dumps(value).encode('utf-8'), 1)
+            rows.append((path, kind, size, ctime, now, len(payload), payload))
+        try:
+            db.execute('BEGIN')
+            db.executemany('INSERT OR REPLACE INTO RunCache VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            (total,) = db.execute('SELECT TOTAL(nbytes) FROM RunCache').fetchone()
+            if total > CONFIG['run_cache_size']:
+                evict = []
+                for (path, kind_, nbytes) in db.execute('SELECT path, kind, nbytes FROM RunCache ORDER BY atime'):
+                    if total <= CONFIG['run_cache_size'] * 0.9:
+                        break
+                    evict.append((path, kind_))
+                    total -= nbytes
+                db.executemany('DELETE FROM RunCache WHERE path = ? AND kind = ?', evict)
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+
+def _cached(kind, filepath, compute):
+    # single-file convenience wrapper around the cache
+    try:
+        key = _cacheKey(filepath)
+    except OSError:
+        return compute(filepath)
+    hit = _cacheGetMany(kind, [key])
+    if key in hit:
+        return hit[key]
+    value = compute(filepath)
+    _cachePutMany(kind, [(key, value)])
+    return value
+
+
+def _defaultKey(filepath):
+
+    if CONFIG['native_reader']:
+        try:
+            records = [_read_cali_first_record(filepath)]
+            if records[0] is None:
+                return ""
+        except CaliFormatError:
+            records = _cali_to_json(filepath)['records']
+    else:
+        records = _cali_to_json(filepath)['records']
     if len(records) == 0:
         return ""
 
@@ -65,6 +654,84 @@ def defaultKey(filepath):
 
     return key
 
+def defaultKey(filepath):
+    return _cached('key', filepath, _defaultKey)
+
+def _defaultKeyOf(filepath):
+    return (filepath, _defaultKey(filepath))
+
+def defaultKeys(filepaths):
+    # {filepath: defaultKey} for many files, looking up the misses in parallel
+    keys = {}
+    for fp in filepaths:
+        try:
+            keys[fp] = _cacheKey(fp)
+        except OSError:
+            keys[fp] = None
+    cached = _cacheGetMany('key', [key for key in keys.values() if key])
+    result = {fp: cached[key] for (fp, key) in keys.items() if key in cached}
+    missing = [fp for fp in filepaths if fp not in result]
+    found = dict(_parallelMap(_defaultKeyOf, missing))
+    _cachePutMany('key', [(keys[fp], found[fp]) for fp in missing if keys[fp]])
+    result.update(found)
+    return {fp: result[fp] for fp in filepaths}
+
+
+# hatchet literals of the .cali files of a notebook, written next to it when the
+# notebook is generated so it opens without re-reading the raw profiles
+
+def _buildHatchetSidecar(item):
+    # write the literal of one file in a worker. Returns (filepath, sidecar, error)
+    (filepath, sidecar) = item
+    try:
+        literal = _hatchetLiteral(_cali_to_json(filepath)['records'], allRoots=True)
+        tmp = '{}.{}.tmp'.format(sidecar, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'cali_file': filepath, 'literal': literal}, f)
+        os.replace(tmp, sidecar)
+        return (filepath, sidecar, None)
+    except Exception as e:
+        return (filepath, None, '{}: {}'.format(type(e).__name__, e))
+
+def _hatchetSidecars(filepaths, sidecarDir):
+    # {filepath: sidecar path, or '' where there is none}. A sidecar is named
+    # after its file's path, size and ctime, so one that exists is up to date;
+    # the outdated sidecars of a file are removed
+    if not CONFIG['hatchet_sidecars']:
+        return {fp: '' for fp in filepaths}
+    sidecarDir = CONFIG['hatchet_sidecar_dir'] or sidecarDir
+    os.makedirs(sidecarDir, exist_ok=True)
+    existing = {}
+    for name in os.listdir(sidecarDir):
+        # not the .tmp files of sidecars another process is writing
+        if name.endswith('.json'):
+            existing.setdefault(name.split('-', 1)[0], []).append(name)
+
+    output = {}
+    missing = []
+    for fp in filepaths:
+        try:
+            st = os.stat(fp)
+        except OSError:
+            output[fp] = ''
+            continue
+        prefix = hashlib.sha1(os.path.abspath(fp).encode('utf-8')).hexdigest()[:16]
+        name = '{}-{}-{}.json'.format(prefix, st.st_size, st.st_ctime_ns)
+        for old in existing.get(prefix, []):
+            if old != name:
+                try:
+                    os.unlink(os.path.join(sidecarDir, old))
+                except OSError:
+                    pass
+        sidecar = os.path.join(sidecarDir, name)
+        if name in existing.get(prefix, []):
+            output[fp] = sidecar
+        else:
+            missing.append((fp, sidecar))
+
+    for (fp, sidecar, error) in _parallelMap(_buildHatchetSidecar, missing):
+        output[fp] = sidecar or ''
+    return output
 
 def get_jupyter_info():
     jsonstr = ""
@@ -103,7 +770,7 @@ def get_jupyter_info():
         resultdict["server"] = host
     return resultdict
 
-def multi_jupyter(args):
+def multi_jupyter(args, out=sys.stdout):
 
     # create notebook in ~/spot_jupyter dir
 
@@ -113,8 +780,11 @@ def multi_jupyter(args):
     isContainer = args.container
 
     if isContainer:
+        metric_names = defaultKeys([os.path.join(cali_path, cali_key) for cali_key in cali_keys])
+        sidecars = _hatchetSidecars([os.path.join(cali_path, cali_key) for cali_key in cali_keys], '/notebooks/.hatchet')
         multi_cali_files = [{ 'cali_file'  : os.path.join(cali_path, cali_key)
-                            , 'metric_name': defaultKey(os.path.join(cali_path, cali_key))
+                            , 'metric_name': metric_names[os.path.join(cali_path, cali_key)]
+                            , 'hatchet_sidecar': sidecars[os.path.join(cali_path, cali_key)]
                             } 
                               for cali_key in cali_keys
                            ]
@@ -133,7 +803,7 @@ def multi_jupyter(args):
 
         jsonret = get_jupyter_info()
         jsonret["path"] = fullpath
-        print(json.dumps(jsonret))
+        print(json.dumps(jsonret), file=out)
 
     else:
         ntbk_dir = os.path.expanduser('~/spot_jupyter')
@@ -150,15 +820,18 @@ def multi_jupyter(args):
         loop0 = 0
         first_metric_name = ""
 
+        metric_names = defaultKeys([cali_path + '/' + i for i in cali_keys])
+        sidecars = _hatchetSidecars([cali_path + '/' + i for i in cali_keys], os.path.join(ntbk_dir, '.hatchet'))
+
         for i in sorted(cali_keys):
             full_c_path = cali_path + '/' + i
-            metric_name = defaultKey(str(full_c_path))
+            metric_name = metric_names[full_c_path]
 
             if loop0 == 0:
                 first_metric_name = metric_name
 
             dira = cali_path + '/' + i
-            line_strs = line_strs + '\\n { \\"cali_file\\": \\"' + dira + '\\", \\"metric_name\\": \\"' + metric_name + '\\"}, '
+            line_strs = line_strs + '\\n { \\"cali_file\\": \\"' + dira + '\\", \\"metric_name\\": \\"' + metric_name + '\\", \\"hatchet_sidecar\\": \\"' + sidecars[dira] + '\\"}, '
             loop0 = loop0 + 1
 
 
@@ -180,11 +853,11 @@ def multi_jupyter(args):
         end_path = urllib.parse.quote(os.path.basename(ntbk_path))
 
         if args.ci_testing:
-            print(ntbk_path)
+            print(ntbk_path, file=out)
         else:
-            print('https://{}lc.llnl.gov/jupyter/user/{}/notebooks/spot_jupyter/{}'.format( rz_or, getpass.getuser(), end_path ))
+            print('https://{}lc.llnl.gov/jupyter/user/{}/notebooks/spot_jupyter/{}'.format( rz_or, getpass.getuser(), end_path ), file=out)
 
-def jupyter(args):
+def jupyter(args, out=sys.stdout):
 
     # create notebook in ~/spot_jupyter dir
 
@@ -201,13 +874,14 @@ def jupyter(args):
         ntbk_template_str = open(CONFIG['template_notebook']).read().replace('CALI_FILE_NAME', str(cali_path)).replace('CALI_METRIC_NAME', str(metric_name))
         ntbk_template_str = ntbk_template_str.replace('CALI_QUERY_PATH', '/usr/gapps/spot/caliper-install/bin')
         ntbk_template_str = ntbk_template_str.replace('DEPLOY_DIR', '/usr/gapps/spot/')
+        ntbk_template_str = ntbk_template_str.replace('HATCHET_SIDECAR', _hatchetSidecars([cali_path], os.path.join('/notebooks', '.hatchet'))[cali_path])
 
         os.makedirs(ntbk_path,exist_ok=True)
         open(ntbk_fullpath, 'w').write(ntbk_template_str)
 
         jsonret = get_jupyter_info()
         jsonret["path"] = ntbk_fullpath
-        print(json.dumps(jsonret))
+        print(json.dumps(jsonret), file=out)
 
     else:
         ntbk_dir = os.path.expanduser('~/spot_jupyter')
@@ -221,6 +895,7 @@ def jupyter(args):
         ntbk_path = os.path.join(ntbk_dir, ntbk_name)
         ntbk_template_str = open(CONFIG['template_notebook']).read().replace('CALI_FILE_NAME', str(cali_path)).replace('CALI_METRIC_NAME', str(metric_name))
         ntbk_template_str = ntbk_template_str.replace('CALI_QUERY_PATH', cali_query_replace)
+        ntbk_template_str = ntbk_template_str.replace('HATCHET_SIDECAR', _hatchetSidecars([cali_path], os.path.join(ntbk_dir, '.hatchet'))[cali_path])
         
         dd = get_deploy_dir()
         ntbk_template_str = ntbk_template_str.replace('DEPLOY_DIR', dd)
@@ -232,9 +907,9 @@ def jupyter(args):
         end_path = urllib.parse.quote(os.path.basename(ntbk_path))
 
         if args.ci_testing:
-            print(ntbk_path)
+            print(ntbk_path, file=out)
         else:
-            print('https://{}lc.llnl.gov/jupyter/user/{}/notebooks/spot_jupyter/{}'.format( rz_or, getpass.getuser(), end_path ))
+            print('https://{}lc.llnl.gov/jupyter/user/{}/notebooks/spot_jupyter/{}'.format( rz_or, getpass.getuser(), end_path ), file=out)
 
 
 def _prependDir(dirpath, fnames):
@@ -245,272 +920,2144 @@ def _getAdiakType(run, global_):
     try: return run['attributes'][global_]["adiak.type"]
     except: return None
 
-def _getAllDatabaseRuns(dbFilepath: str, lastRead: int):
-    if dbFilepath.endswith('.yaml'):
+# pool of idle database connections per database, so repeated calls (and the
+# server) don't reconnect or re-read the yaml config each time
+
+_DB_CONNECTIONS = {}
+_DB_CONFIGS = {}
+_DB_CONNECTIONS_LOCK = threading.Lock()
+
+def _dbConfig(dbFilepath):
+    mtime = os.stat(dbFilepath).st_mtime
+    with _DB_CONNECTIONS_LOCK:
+        cached = _DB_CONFIGS.get(dbFilepath)
+    if cached is None or cached[0] != mtime:
         import yaml
+        cached = (mtime, yaml.load(open(dbFilepath), Loader=yaml.FullLoader))
+        with _DB_CONNECTIONS_LOCK:
+            _DB_CONFIGS[dbFilepath] = cached
+    return cached[1]
+
+def _connectDB(dbFilepath):
+    if dbFilepath.endswith('.yaml'):
         import mysql.connector
-        dbConfig = yaml.load(open(dbFilepath), Loader=yaml.FullLoader)
-        mydb = mysql.connector.connect(**dbConfig)
-        db_placeholder = "%s"
+        return mysql.connector.connect(**_dbConfig(dbFilepath))
     else:
         import sqlite3
-        mydb = sqlite3.connect(dbFilepath)
-        db_placeholder = "?"
-
-    cursor = mydb.cursor()
+        return sqlite3.connect(dbFilepath, check_same_thread=False)
+
+class _DBConnection:
+    # `with _DBConnection(db) as (cursor, db_placeholder):`
+    # takes an idle connection from the pool and hands it back afterwards.
+    # The cursor is unbuffered; read it with _fetchRows
+
+    def __init__(self, dbFilepath):
+        self.dbFilepath = dbFilepath
+        self.isMysql = dbFilepath.endswith('.yaml')
+        self.placeholder = "%s" if self.isMysql else "?"
+        self.conn = None
+
+    def __enter__(self):
+        with _DB_CONNECTIONS_LOCK:
+            idle = _DB_CONNECTIONS.get(self.dbFilepath)
+            while idle and self.conn is None:
+                self.conn = idle.pop()
+                if self.isMysql and not self.conn.is_connected():
+                    self.conn = None
+        if self.conn is None:
+            self.conn = _connectDB(self.dbFilepath)
+        if self.isMysql:
+            return (self.conn.cursor(buffered=False), self.placeholder)
+        return (self.conn.cursor(), self.placeholder)
+
+    def __exit__(self, excType, excValue, tb):
+        # a failed or abandoned query may leave unread results: drop that connection
+        if excType is None:
+            # end the read transaction so the next user sees fresh data
+            self.conn.rollback()
+            with _DB_CONNECTIONS_LOCK:
+                idle = _DB_CONNECTIONS.setdefault(self.dbFilepath, [])
+                if len(idle) < CONFIG['db_pool_size']:
+                    idle.append(self.conn)
+                    return False
+        self.conn.close()
+        return False
+
+def _fetchRows(cursor, batchSize=None):
+    # iterate a result set in fetchmany batches
+    batchSize = batchSize or CONFIG['db_fetch_size']
+    while True:
+        rows = cursor.fetchmany(batchSize)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+class _RunFilter:
+    # selection of getData: only runs whose globals satisfy every predicate
+    # ('name=value', 'name!=value', or 'name' <, <=, >, >= a number), and of
+    # those only the given metrics of call paths under pathPrefix, at most
+    # maxDepth deep. = and != compare text, the others compare numbers
+    _PREDICATE = re.compile(r'^(.+?)(>=|<=|!=|=|>|<)(.*)$')
+    _OPS = { '=': lambda a, b: a == b
+           , '!=': lambda a, b: a != b
+           , '<': lambda a, b: a < b
+           , '<=': lambda a, b: a <= b
+           , '>': lambda a, b: a > b
+           , '>=': lambda a, b: a >= b
+           }
 
-    # get runs
-    runs = {}
-    runNum = int(lastRead)
-    cursor.execute('SELECT run, globals, records FROM Runs Where run > ' + db_placeholder, (runNum,))
-    for (runNum, _globals, record) in cursor:
-        runData = {}
-        for rec in json.loads(record):
-            funcpath = rec.pop('path', None)
-            if funcpath:
-                runData[funcpath] = rec
+    def __init__(self, metrics=None, pathPrefix=None, maxDepth=None, where=()):
+        self.metrics = set(metrics) if metrics else None
+        self.pathPrefix = pathPrefix.strip('/') if pathPrefix else None
+        self.maxDepth = maxDepth
+        self.predicates = []
+        for predicate in where:
+            match = self._PREDICATE.match(predicate)
+            if not match:
+                raise ValueError('invalid predicate: {}'.format(predicate))
+            (global_, op, value) = match.groups()
+            if op not in ('=', '!='):
+                value = float(value)
+            self.predicates.append((global_, op, value))
+        self.projects = bool(self.metrics or self.pathPrefix or self.maxDepth)
+
+    @classmethod
+    def fromArgs(cls, args):
+        return cls( args.metrics.split(',') if args.metrics else None
+                  , args.pathPrefix
+                  , args.maxDepth
+                  , args.where or ()
+                  )
+
+    def matches(self, runGlobals):
+        for (global_, op, value) in self.predicates:
+            val = runGlobals.get(global_)
+            if val is None:
+                return False
+            try:
+                val = str(val) if op in ('=', '!=') else float(val)
+            except (TypeError, ValueError):
+                return False
+            if not self._OPS[op](val, value):
+                return False
+        return True
+
+    def keepsPath(self, funcpath):
+        if self.pathPrefix and not (funcpath == self.pathPrefix or funcpath.startswith(self.pathPrefix + '/')):
+            return False
+        return not self.maxDepth or funcpath.count('/') < self.maxDepth
+
+    def project(self, runData):
+        # {path: record} restricted to the selected paths and metrics
+        if not self.projects:
+            return runData
+        output = {}
+        for (funcpath, record) in runData.items():
+            if self.keepsPath(funcpath):
+                if self.metrics:
+                    record = {metricName: val for (metricName, val) in record.items() if metricName in self.metrics}
+                if record:
+                    output[funcpath] = record
+        return output
+
+    def projectMeta(self, runDataMeta):
+        if not self.metrics:
+            return runDataMeta
+        return {metricName: val for (metricName, val) in runDataMeta.items() if metricName in self.metrics}
+
+    def sqlWhere(self, db_placeholder):
+        # the predicates as SQL conditions on the json Runs.globals column, and their parameters
+        if db_placeholder == '%s':
+            text = 'JSON_UNQUOTE(JSON_EXTRACT(globals, %s))'
+        else:
+            text = 'CAST(json_extract(globals, ?) AS TEXT)'
+        clauses = []
+        params = []
+        for (global_, op, value) in self.predicates:
+            expr = text if op in ('=', '!=') else '(' + text + ' + 0)'
+            clauses.append('{} IS NOT NULL AND {} {} {}'.format(text, expr, op, db_placeholder))
+            params += ['$."{}"'.format(global_.replace('"', '\\"'))] * 2 + [value]
+        return (clauses, params)
+
+    def sqlIngestedWhere(self):
+        # the predicates as conditions on spot_runs of an ingested database
+        clauses = []
+        params = []
+        for (global_, op, value) in self.predicates:
+            expr = 'CAST(g.value AS TEXT)' if op in ('=', '!=') else '(g.value + 0)'
+            clauses.append('EXISTS (SELECT 1 FROM spot_globals g WHERE g.run = spot_runs.id AND g.name = ? AND {} {} ?)'.format(expr, op))
+            params += [global_, value]
+        return (clauses, params)
+
+    def sqlIngestedProjection(self):
+        # the path and metric selection as conditions on spot_paths p and spot_metrics m
+        clauses = []
+        params = []
+        if self.metrics:
+            clauses.append('m.name IN ({})'.format(', '.join(['?'] * len(self.metrics))))
+            params += sorted(self.metrics)
+        if self.pathPrefix:
+            clauses.append('(p.path = ? OR substr(p.path, 1, ?) = ?)')
+            params += [self.pathPrefix, len(self.pathPrefix) + 1, self.pathPrefix + '/']
+        if self.maxDepth:
+            clauses.append('p.depth <= ?')
+            params.append(self.maxDepth)
+        return (clauses, params)
+
+_NO_FILTER = _RunFilter()
+
+def _getAllDatabaseRuns(dbFilepath: str, lastRead: int, summary=False):
+    meta = {}
+    runs = dict(_iterDatabaseRuns(dbFilepath, lastRead, meta, summary=summary))
+    return dict(Runs=runs, **meta)
+
+def _iterDatabaseRuns(dbFilepath, lastRead, meta, runFilter=_NO_FILTER, summary=False, runIds=None, shard=None):
+    # yields (runNum, {Globals, Data}) while reading, then fills in meta.
+    # Global predicates of runFilter are evaluated by the database.
+    # summary: only read the globals. runIds: read these runs instead of those after lastRead.
+    # shard: (i, n) to only read the runs whose number is i modulo n
+    prof = _profile()
+    columns = 'run, globals' if summary else 'run, globals, records'
+    with _DBConnection(dbFilepath) as (cursor, db_placeholder):
+        # get runs
+        runNum = int(lastRead)
+        (clauses, params) = runFilter.sqlWhere(db_placeholder)
+        if shard:
+            clauses.append('MOD(run, {}) = {}'.format(shard[1], shard[0]) if db_placeholder == '%s' else 'run % {} = {}'.format(shard[1], shard[0]))
+        if runIds is None:
+            queries = [('run > ' + db_placeholder, [runNum])]
+        else:
+            queries = [('run IN ({})'.format(', '.join([db_placeholder] * len(runIds[i:i+500]))), runIds[i:i+500])
+                       for i in range(0, len(runIds), 500)]
+        for (where, whereParams) in queries:
+            with prof.phase('query'):
+                cursor.execute(' AND '.join(['SELECT {} FROM Runs Where {}'.format(columns, where)] + clauses), list(whereParams) + params)
+            for row in prof.timed('fetch', _fetchRows(cursor)):
+                (runNum, _globals) = row[:2]
+                if summary:
+                    yield (runNum, {'Globals': json.loads(_globals)})
+                    continue
+                record = row[2]
+                with prof.phase('decode') as stats:
+                    runData = {}
+                    for rec in json.loads(record):
+                        funcpath = rec.pop('path', None)
+                        if funcpath:
+                            runData[funcpath] = rec
+                    runData = runFilter.project(runData)
+
+                    runGlobals = json.loads(_globals)
+                    stats['count'] = 1
+                    stats['bytes'] = len(record) + len(_globals)
+                yield (runNum, {'Globals': runGlobals, 'Data': runData})
+
+        # get global meta
+        cursor.execute('SELECT name, datatype FROM Metadata')
+        runGlobalMeta = {name: {'type': datatype} for (name, datatype) in _fetchRows(cursor) if datatype is not None}
+
+    # meta['RunDataMeta'] = runNum
+    meta['RunGlobalMeta'] = runGlobalMeta
+    if runIds is None:
+        meta['RunSetMeta'] = {'LastReadPosix': runNum}
+
+def _normalizeCaliRun(run):
+    # cali-query json -> {Data, Globals, RunDataMeta, RunGlobalMeta} for a single run
+    runData = {}
+    runDataMeta = {}
 
-        runGlobals = json.loads(_globals)
-        runs[runNum] = {'Globals': runGlobals, 'Data': runData}
+    # get runData and runDataMeta
+    for record in run['records']:
+        funcpath = record.pop('path', None)
+        if funcpath:
+            runData[funcpath] = record
+    for metricName in list(runData.items())[0][1]:
+        runDataMeta[metricName] = {'type': run['attributes'][metricName]["cali.attribute.type"]}
 
-    # get global meta
-    cursor.execute('SELECT name, datatype FROM Metadata')
-    runGlobalMeta = {name: {'type': datatype} for (name, datatype) in cursor if datatype is not None}
+    (runGlobals, runGlobalMeta) = _normalizeCaliGlobals(run)
 
-    return { 'Runs': runs
-           # 'RunDataMeta': runNum
+    return { 'Data': runData
+           , 'Globals': runGlobals
+           , 'RunDataMeta': runDataMeta
            , 'RunGlobalMeta': runGlobalMeta
-           , 'RunSetMeta': {'LastReadPosix': runNum}
            }
 
-def _getAllCaliRuns(filepath, subpaths):
-    import multiprocessing
+def _normalizeCaliGlobals(run):
+    # the adiak globals of a cali-query json run and their types
+    runGlobals = {}
+    runGlobalMeta = {}
 
-    cali_json = []
-    try:
-        cali_json = multiprocessing.Pool(18).map( _cali_to_json, _prependDir(filepath, subpaths))
-    except:
-        for fp in _prependDir(filepath, subpaths):
-            cali_json.append(_cali_to_json(fp))
+    for (global_, val) in run['globals'].items():
+        adiakType = _getAdiakType(run, global_)
 
-    # process all new files to transfer to front-end
-    runs = {}
-    runDataMeta = {}
-    runGlobalMeta = {}
+        if global_ == "spot.options":
+            if val == "timeseries":
+                runGlobals['timeseries'] = 1
 
-    for (subpath, run) in zip(subpaths, cali_json):
-
-        runData = {}
-        runGlobals = {}
-
-        # get runData and runDataMeta
-        for record in run['records']:
-            funcpath = record.pop('path', None)
-            if funcpath:
-                runData[funcpath] = record
-        for metricName in list(runData.items())[0][1]:
-            runDataMeta[metricName] = {'type': run['attributes'][metricName]["cali.attribute.type"]}
-
-        # get runGlobals and runGlobalMeta
-        for (global_, val) in run['globals'].items():
-            adiakType = _getAdiakType(run, global_)
-            
-            if global_ == "spot.options":
-                if val == "timeseries":
-                    runGlobals['timeseries'] = 1
-
-            if adiakType:
-                runGlobals[global_] = val
-          
-                runGlobalMeta[global_] = {'type': adiakType}
+        if adiakType:
+            runGlobals[global_] = val
 
-        # collect run
-        runs[subpath] = { 'Data': runData
-                      , 'Globals': runGlobals
-                      }
+            runGlobalMeta[global_] = {'type': adiakType}
+
+    return (runGlobals, runGlobalMeta)
+
+_POOL = None
+
+def _cgroupCpuLimit():
+    # cpu quota of the cgroup we run in (v2, then v1), or None if unlimited
+    try:
+        (quota, period) = open('/sys/fs/cgroup/cpu.max').read().split()
+        if quota != 'max':
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us').read())
+        period = int(open('/sys/fs/cgroup/cpu/cpu.cfs_period_us').read())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _workerCount():
+    if CONFIG['workers']:
+        return CONFIG['workers']
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    limit = _cgroupCpuLimit()
+    if limit:
+        count = min(count, int(limit + 0.5) or 1)
+    return count
+
+def _workerPool():
+    # created on first use and reused, so the server keeps its workers warm
+    import multiprocessing
+    global _POOL
+    if _POOL is None:
+        _POOL = multiprocessing.Pool(_workerCount())
+    return _POOL
+
+def _parallelMap(func, items):
+    # unordered map over the worker pool in chunks; in-process when there is
+    # a single item or no pool can be created
+    if len(items) < 2 or _workerCount() < 2:
+        return map(func, items)
+    try:
+        pool = _workerPool()
+    except OSError:
+        return map(func, items)
+    chunksize = max(1, min(16, len(items) // (_workerCount() * 4)))
+    return pool.imap_unordered(func, items, chunksize)
+
+def _fileTimeout(signum, frame):
+    raise TimeoutError('gave up after {} seconds'.format(CONFIG['file_timeout']))
+
+def _parseCaliRun(filepath, summary=False):
+    # parse and normalize one file in a worker. Returns (filepath, run, error, stats)
+    # so a bad file is reported instead of failing the whole batch; stats are
+    # the file's size and read/normalize times for profiling.
+    # summary: only read the globals, run is {Globals, RunGlobalMeta}
+    import signal
+    useAlarm = CONFIG['file_timeout'] and threading.current_thread() is threading.main_thread()
+    if useAlarm:
+        # restored afterwards: in-process callers (serve, defaultKeys) may have their own
+        oldHandler = signal.signal(signal.SIGALRM, _fileTimeout)
+        signal.setitimer(signal.ITIMER_REAL, CONFIG['file_timeout'])
+    stats = {'bytes': 0, 'read': 0.0, 'normalize': 0.0}
+    start = time.perf_counter()
+    try:
+        stats['bytes'] = os.path.getsize(filepath)
+        parsed = _cali_globals_to_json(filepath) if summary else _cali_to_json(filepath)
+        stats['read'] = time.perf_counter() - start
+        if summary:
+            run = dict(zip(('Globals', 'RunGlobalMeta'), _normalizeCaliGlobals(parsed)))
+        else:
+            run = _normalizeCaliRun(parsed)
+        stats['normalize'] = time.perf_counter() - start - stats['read']
+        return (filepath, run, None, stats)
+    except Exception as e:
+        return (filepath, None, '{}: {}'.format(type(e).__name__, e), stats)
+    finally:
+        stats['seconds'] = time.perf_counter() - start
+        if useAlarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL if oldHandler is None else oldHandler)
+
+def _getAllCaliRuns(filepath, subpaths, runStats=None, summary=False):
+    meta = {}
+    runs = dict(_iterCaliRuns(filepath, subpaths, runStats, meta, summary=summary))
 
     # output new data
     return { 'Runs': runs
-           , 'RunDataMeta': runDataMeta
-           , 'RunGlobalMeta': runGlobalMeta
+           , 'RunDataMeta': meta['RunDataMeta']
+           , 'RunGlobalMeta': meta['RunGlobalMeta']
+           , 'failedRuns': meta['failedRuns']
            }
 
-def _getAllJsonRuns(filepath, subpaths):
-    output = {}
-    runs = {}
-    for subpath in subpaths:
-        try:
-            data = json.load(open(os.path.join(filepath, subpath)))
-            commits = data.pop('commits')
-            title = data.pop('title')
-            yAxis = data.pop('yAxis')
-            show_exclusive = data.pop('show_exclusive')
-            series = data.pop('series')
-            dates = [str(int(datetime.strptime(date, '%a %b %d %H:%M:%S %Y\n').timestamp())) for date in data.pop('XTics')]
-            runSetName = subpath[0:subpath.find('.json')]
-
-            for i in range(len(dates)):
-                runs[runSetName + '-' + str(i)] = { 'Globals': { 'launchdate': dates[i]
-                                                            , 'commit': commits[i]
-                                                            , 'title': title
-                                                            }
-                                                , 'Data': {}
-                                                }
-
-
-            for funcpath, values in data.items():
-                for value in values:
-                    runs[runSetName + '-' + str(value[0])]['Data']['main'] = {yAxis: 0}
-                    runs[runSetName + '-' + str(value[0])]['Data']['main/'+funcpath] = {yAxis: value[1]}
-        except: pass
-
+def _iterCaliRuns(filepath, subpaths, runStats, meta, batchSize=256, runFilter=_NO_FILTER, summary=False):
+    # yields (subpath, {Data, Globals}) as runs come out of the cache or get
+    # parsed, and collects RunDataMeta/RunGlobalMeta and the errors of files
+    # that could not be read ({subpath: error}, as failedRuns) into meta.
+    # runStats: optional {subpath: (st_size, st_ctime)} from the directory scan.
+    # The cache keeps whole runs; runFilter is applied as they are collected.
+    # summary: only {Globals}, from a parse that skips the records
+    runDataMeta = meta.setdefault('RunDataMeta', {})
+    runGlobalMeta = meta.setdefault('RunGlobalMeta', {})
+    failedRuns = meta.setdefault('failedRuns', {})
+    prof = _profile()
+
+    kind = 'summary' if summary else 'run'
+    parse = functools.partial(_parseCaliRun, summary=True) if summary else _parseCaliRun
+
+    def collect(subpath, run):
+        if not runFilter.matches(run['Globals']):
+            return None
+        runGlobalMeta.update(run['RunGlobalMeta'])
+        if summary:
+            return (subpath, {'Globals': run['Globals']})
+        runDataMeta.update(runFilter.projectMeta(run['RunDataMeta']))
+        return (subpath, {'Data': runFilter.project(run['Data']), 'Globals': run['Globals']})
+
+    # reuse cached runs, parse the rest
+    missing = {}
+    for i in range(0, len(subpaths), batchSize):
+        batch = subpaths[i:i+batchSize]
+        if runStats:
+            keys = [(os.path.abspath(fp),) + tuple(runStats[subpath]) for (subpath, fp) in zip(batch, _prependDir(filepath, batch))]
+        else:
+            keys = [_cacheKey(fp) for fp in _prependDir(filepath, batch)]
+        with prof.phase('cacheLookup') as stats:
+            cachedRuns = _cacheGetMany(kind, keys)
+            stats['count'] = len(cachedRuns)
+        for (subpath, key) in zip(batch, keys):
+            if key in cachedRuns:
+                collected = collect(subpath, cachedRuns[key])
+                if collected:
+                    yield collected
+            else:
+                missing[key[0]] = (subpath, key)
+
+    parsedRuns = []
+    # read/normalize times are summed over the workers
+    for (fp, run, error, stats) in _parallelMap(parse, list(missing)):
+        (subpath, key) = missing[fp]
+        prof.addFile(subpath, stats)
+        prof.add('read', stats['read'], 1, stats['bytes'])
+        prof.add('normalize', stats['normalize'], 1)
+        if error:
+            failedRuns[subpath] = error
+            continue
+        parsedRuns.append((key, run))
+        if len(parsedRuns) == batchSize:
+            with prof.phase('cacheStore') as stats:
+                _cachePutMany(kind, parsedRuns)
+                stats['count'] = len(parsedRuns)
+            parsedRuns = []
+        collected = collect(subpath, run)
+        if collected:
+            yield collected
+    with prof.phase('cacheStore') as stats:
+        _cachePutMany(kind, parsedRuns)
+        stats['count'] = len(parsedRuns)
+
+# legacy run sets: one .json file of several runs, drawn as a series of
+# values per call path over the XTics dates. Its runs are keyed by the
+# file's subpath without .json, a dash and their index
+
+_MONTHS = {month: i for (i, month) in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+def _xticTimestamps(tics):
+    # posix time strings of 'Wed Nov 13 15:08:54 2019\n' dates, local time as with
+    # datetime.strptime. A run set repeats few dates, so each distinct one is
+    # converted once, without strptime unless it is irregular
+    converted = {}
+    output = []
+    for tic in tics:
+        ts = converted.get(tic)
+        if ts is None:
+            try:
+                (_, month, day, hms, year) = tic.split()
+                (hour, minute, second) = hms.split(':')
+                date = datetime(int(year), _MONTHS[month], int(day), int(hour), int(minute), int(second))
+            except (ValueError, KeyError):
+                date = datetime.strptime(tic, '%a %b %d %H:%M:%S %Y\n')
+            ts = converted[tic] = str(int(date.timestamp()))
+        output.append(ts)
+    return output
 
+def _parseJsonRunSet(filepath):
+    # parse one run set in a worker. Returns (filepath, {Runs: {index: run}, RunDataMeta}, error, stats)
+    stats = {'bytes': 0}
+    start = time.perf_counter()
+    try:
+        stats['bytes'] = os.path.getsize(filepath)
+        with open(filepath) as f:
+            data = json.load(f)
+        commits = data.pop('commits')
+        title = data.pop('title')
+        yAxis = data.pop('yAxis')
+        data.pop('show_exclusive')
+        data.pop('series')
+        dates = _xticTimestamps(data.pop('XTics'))
+
+        runs = {}
+        for i in range(len(dates)):
+            runs[str(i)] = { 'Globals': { 'launchdate': dates[i]
+                                        , 'commit': commits[i]
+                                        , 'title': title
+                                        }
+                           , 'Data': {}
+                           }
+
+        for funcpath, values in data.items():
+            for value in values:
+                run = runs.get(str(value[0]))
+                if run is None:
+                    raise ValueError('{}: no XTic for run {}'.format(funcpath, value[0]))
+                run['Data']['main'] = {yAxis: 0}
+                run['Data']['main/' + funcpath] = {yAxis: value[1]}
+        return (filepath, {'Runs': runs, 'RunDataMeta': {yAxis: {'type': 'double'}}}, None, stats)
+    except Exception as e:
+        return (filepath, None, '{}: {}'.format(type(e).__name__, e), stats)
+    finally:
+        stats['seconds'] = time.perf_counter() - start
+
+def _iterJsonRuns(filepath, subpaths, runStats, meta, runFilter=_NO_FILTER, summary=False, runSets=None, runKeys=None):
+    # as _iterCaliRuns for the run sets at subpaths. runSets is filled with
+    # {subpath: [runKey]} of every set read; runKeys: only yield these runs
+    runDataMeta = meta.setdefault('RunDataMeta', {})
+    runGlobalMeta = meta.setdefault('RunGlobalMeta', {})
+    failedRuns = meta.setdefault('failedRuns', {})
+    prof = _profile()
+    runSets = {} if runSets is None else runSets
+    runKeys = None if runKeys is None else set(runKeys)
+
+    def collect(subpath, runSet):
+        runGlobalMeta.update({ 'launchdate': {'type': 'date'}
+                             , 'commit': {'type': 'string'}
+                             })
+        if not summary:
+            runDataMeta.update(runFilter.projectMeta(runSet['RunDataMeta']))
+        runSetName = subpath[0:subpath.find('.json')]
+        runSets[subpath] = []
+        for (i, run) in runSet['Runs'].items():
+            runKey = runSetName + '-' + i
+            runSets[subpath].append(runKey)
+            if not runFilter.matches(run['Globals']) or (runKeys is not None and runKey not in runKeys):
+                continue
+            if summary:
+                yield (runKey, {'Globals': run['Globals']})
+            else:
+                yield (runKey, {'Globals': run['Globals'], 'Data': runFilter.project(run['Data'])})
+
+    if runStats:
+        keys = [(os.path.abspath(fp),) + tuple(runStats[subpath]) for (subpath, fp) in zip(subpaths, _prependDir(filepath, subpaths))]
+    else:
+        keys = [_cacheKey(fp) for fp in _prependDir(filepath, subpaths)]
+    with prof.phase('cacheLookup') as stats:
+        cachedRunSets = _cacheGetMany('runset', keys)
+        stats['count'] = len(cachedRunSets)
+
+    missing = {}
+    for (subpath, key) in zip(subpaths, keys):
+        if key in cachedRunSets:
+            yield from collect(subpath, cachedRunSets[key])
+        else:
+            missing[key[0]] = (subpath, key)
+
+    parsedRunSets = []
+    for (fp, runSet, error, stats) in _parallelMap(_parseJsonRunSet, list(missing)):
+        (subpath, key) = missing[fp]
+        prof.addFile(subpath, stats)
+        prof.add('json', stats['seconds'], 1, stats['bytes'])
+        if error:
+            failedRuns[subpath] = error
+            continue
+        parsedRunSets.append((key, runSet))
+        yield from collect(subpath, runSet)
+    with prof.phase('cacheStore') as stats:
+        _cachePutMany('runset', parsedRunSets)
+        stats['count'] = len(parsedRunSets)
 
+def _getAllJsonRuns(filepath, subpaths):
+    meta = {}
+    runs = dict(_iterJsonRuns(filepath, subpaths, None, meta))
 
     return { 'Runs': runs
-           , 'RunDataMeta': {'yAxis': {'type': 'double'}}
-           , 'RunGlobalMeta': { 'launchdate': {'type': 'date'}
-                              , 'commit': {'type': 'string'}
-                              }
+           , 'RunDataMeta': meta['RunDataMeta']
+           , 'RunGlobalMeta': meta['RunGlobalMeta']
+           , 'failedRuns': meta['failedRuns']
            }
 
 
-def memoryGraph(args):
+def _lttb(xs, ys, n):
+    # indices of the n points picked by largest-triangle-three-buckets
+    size = len(xs)
+    if n >= size or n < 3:
+        return list(range(size))
+    every = (size - 2) / (n - 2)
+    a = 0
+    picked = [0]
+    for i in range(n - 2):
+        # the next bucket is represented by its average point
+        nextStart = int((i + 1) * every) + 1
+        nextEnd = min(int((i + 2) * every) + 1, size)
+        avgX = sum(xs[nextStart:nextEnd]) / (nextEnd - nextStart)
+        avgY = sum(ys[nextStart:nextEnd]) / (nextEnd - nextStart)
+
+        maxArea = -1
+        for j in range(int(i * every) + 1, nextStart):
+            area = abs((xs[a] - avgX) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avgY - ys[a]))
+            if area > maxArea:
+                maxArea = area
+                next_a = j
+        picked.append(next_a)
+        a = next_a
+    picked.append(size - 1)
+    return picked
+
+def _minMaxBuckets(ys, n):
+    # indices of the min and max point of n/2 equal-count buckets
+    size = len(ys)
+    if n >= size or n < 2:
+        return list(range(size))
+    buckets = n // 2
+    picked = []
+    for b in range(buckets):
+        bucket = range(b * size // buckets, (b + 1) * size // buckets)
+        lo = min(bucket, key=ys.__getitem__)
+        hi = max(bucket, key=ys.__getitem__)
+        picked.extend(sorted({lo, hi}))
+    return picked
+
+def _timeseriesMetric(series, xattr):
+    # first spot.timeseries.metrics entry, or else the first numeric attribute
+    names = str(series['globals'].get('spot.timeseries.metrics', '')).split(',')
+    records = series['records']
+    for name in names:
+        if records and name in records[0]:
+            return name
+    for rec in records:
+        for (name, val) in rec.items():
+            if name != xattr and isinstance(val, (int, float)) and not isinstance(val, bool):
+                return name
+    return None
+
+def _timeseriesWindow(filepath, xattr, start, end):
+    # timeseries records with start <= x <= end, sorted by x
+    series = _cali_timeseries_to_json(filepath)
+    records = [rec for rec in series['records']
+               if isinstance(rec.get(xattr), (int, float))
+                  and (start is None or rec[xattr] >= start)
+                  and (end is None or rec[xattr] <= end)]
+    records.sort(key=lambda rec: rec[xattr])
+    series['records'] = records
+    return series
+
+def _timeseriesRange(filepath, xattr, start, end):
+    # [min x, max x] of the windowed series, None if it is empty
+    records = _timeseriesWindow(filepath, xattr, start, end)['records']
+    return [records[0][xattr], records[-1][xattr]] if records else None
+
+def _downsampledTimeseries(filepath, xattr, start, end, points, method, metric):
+    # the windowed series with each path's records thinned out to about
+    # `points` shape-preserving records
+    if start is None and end is None and not points:
+        return _cali_timeseries_to_json(filepath)
+    series = _timeseriesWindow(filepath, xattr, start, end)
+    metric = metric or _timeseriesMetric(series, xattr)
+    if not points or not metric:
+        return series
+
+    byPath = {}
+    for rec in series['records']:
+        if isinstance(rec.get(metric), (int, float)):
+            byPath.setdefault(rec.get('path'), []).append(rec)
+    records = []
+    for recs in byPath.values():
+        xs = [rec[xattr] for rec in recs]
+        ys = [rec[metric] for rec in recs]
+        picked = _lttb(xs, ys, points) if method == 'lttb' else _minMaxBuckets(ys, points)
+        records.extend(recs[i] for i in picked)
+    records.sort(key=lambda rec: rec[xattr])
+    series['records'] = records
+    series['downsampling'] = {'method': method, 'metric': metric, 'points': points}
+    return series
+
+def _alignedTimeseries(filepath, xattr, lo, hi, points):
+    # {path: {metric: [mean per bucket]}} over `points` equal-width buckets of [lo, hi]
+    series = _timeseriesWindow(filepath, xattr, lo, hi)
+    width = (hi - lo) / points or 1
+    sums = {}
+    for rec in series['records']:
+        b = min(int((rec[xattr] - lo) / width), points - 1)
+        for (name, val) in rec.items():
+            if name != xattr and isinstance(val, (int, float)) and not isinstance(val, bool):
+                acc = sums.setdefault(rec.get('path'), {}).setdefault(name, [[0.0, 0] for _ in range(points)])
+                acc[b][0] += val
+                acc[b][1] += 1
+    return { 'globals': series['globals']
+           , 'series': {path: {name: [(s / n if n else None) for (s, n) in acc] for (name, acc) in metrics.items()}
+                        for (path, metrics) in sums.items()}
+           }
 
-    cali_path = args.cali_filepath
+def memoryGraph(args, out=sys.stdout):
+
+    cali_paths = args.cali_filepath
+    xattr = args.x
+    points = args.points
 
     #dd = get_deploy_dir()
     #opdat = open( dd + '/templates/lo.json').read()
 
-    #filepath = "/usr/gapps/spot/datasets/lulesh_gen/100/33.cali"
-    filepath = "/g/g0/pascal/spot_lulesh_timeseries_membw_8x4b.cali"
-    series = _cali_timeseries_to_json( cali_path )
-
     output = {}
-    #output['std'] = opdat
-    output['series'] = series
-    output['cali_path'] = cali_path
 
-    json.dump(output, sys.stdout, indent=4)
+    # several runs: per-run series averaged onto one shared grid of buckets
+    if len(cali_paths) > 1:
+        (lo, hi) = (args.start, args.end)
+        if lo is None or hi is None:
+            # each file's [min x, max x] is cached, so a warm request parses nothing
+            rangeKind = 'memory:range:{}:{!r}:{!r}'.format(xattr, args.start, args.end)
+            ranges = [_cached(rangeKind, fp, lambda fp: _timeseriesRange(fp, xattr, args.start, args.end)) for fp in cali_paths]
+            ranges = [range_ for range_ in ranges if range_] or [[0, 0]]
+            if lo is None:
+                lo = min(range_[0] for range_ in ranges)
+            if hi is None:
+                hi = max(range_[1] for range_ in ranges)
+        points = points or 200
+        width = (hi - lo) / points or 1
+        kind = 'memory:aligned:{}:{!r}:{!r}:{}'.format(xattr, lo, hi, points)
+        output['x'] = [lo + (i + 0.5) * width for i in range(points)]
+        output['runs'] = {fp: _cached(kind, fp, lambda fp: _alignedTimeseries(fp, xattr, lo, hi, points)) for fp in cali_paths}
+        output['cali_paths'] = cali_paths
+
+    else:
+        cali_path = cali_paths[0]
+        kind = 'memory:{}:{!r}:{!r}:{}:{}:{}'.format(xattr, args.start, args.end, points, args.method, args.metric)
+        series = _cached(kind, cali_path, lambda fp: _downsampledTimeseries(fp, xattr, args.start, args.end, points, args.method, args.metric))
+
+        #output['std'] = opdat
+        output['series'] = series
+        output['cali_path'] = cali_path
+
+    json.dump(output, out, indent=4)
+
+
+# directory scanning.  The manifest of a dataset remembers, per directory, its
+# mtime, subdirectories and the (st_size, st_ctime) of its data files.  A directory
+# whose mtime is unchanged has had no entries added, removed or renamed, but its
+# files may still have been rewritten or touched, so every file is stat'ed again.
+# Only with CONFIG['append_only_datasets'], for datasets whose files are never
+# changed once written, is the listing of such a directory taken from the manifest.
+
+_MANIFESTS = {}
+_MANIFESTS_LOCK = threading.Lock()
+
+def _loadManifest(dataset):
+    import sqlite3
+    with _MANIFESTS_LOCK:
+        manifest = _MANIFESTS.get(dataset)
+    if manifest is not None:
+        return manifest
+    manifest = {}
+    with _RUN_CACHE_LOCK:
+        db = _runCache()
+        if db:
+            try:
+                for (dir_, mtime, entries) in db.execute('SELECT dir, mtime, entries FROM Manifests WHERE dataset = ?', (dataset,)):
+                    (files, dirs) = json.loads(entries)
+                    manifest[dir_] = (mtime, files, dirs)
+            except sqlite3.Error:
+                manifest = {}
+    return manifest
+
+def _saveManifest(dataset, manifest, updated, removed):
+    import sqlite3
+    with _MANIFESTS_LOCK:
+        if _SERVING:
+            _MANIFESTS[dataset] = manifest
+    if not updated and not removed:
+        return
+    with _RUN_CACHE_LOCK:
+        db = _runCache()
+        if not db:
+            return
+        try:
+            db.execute('BEGIN')
+            db.executemany('INSERT OR REPLACE INTO Manifests VALUES (?, ?, ?, ?)',
+                           [(dataset, dir_, manifest[dir_][0], json.dumps(manifest[dir_][1:])) for dir_ in updated])
+            db.executemany('DELETE FROM Manifests WHERE dataset = ? AND dir = ?', [(dataset, dir_) for dir_ in removed])
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+
+def _walkDataSet(dataSetKey):
+    # walk dataSetKey once and return its manifest
+    dataset = os.path.abspath(dataSetKey)
+    oldManifest = _loadManifest(dataset)
+    manifest = {}
+    updated = []
+    # directories modified within the last second may still change within the same mtime tick
+    racyMtime = time.time() - 1.0
+
+    stack = [(dataset, '', os.stat(dataset).st_mtime)]
+    while stack:
+        (dirpath, prefix, mtime) = stack.pop()
+        entry = oldManifest.get(prefix)
+        if CONFIG['append_only_datasets'] and entry is not None and entry[0] == mtime and mtime < racyMtime:
+            (_, files, dirs) = entry
+        else:
+            files = {}
+            dirs = []
+            with os.scandir(dirpath) as it:
+                for dirEntry in it:
+                    if dirEntry.is_dir(follow_symlinks=False):
+                        dirs.append(dirEntry.name)
+                    elif dirEntry.name.endswith(('.cali', '.json')):
+                        st = dirEntry.stat()
+                        files[dirEntry.name] = [st.st_size, st.st_ctime]
+            if entry is None or [mtime, files, dirs] != list(entry):
+                updated.append(prefix)
+        manifest[prefix] = (mtime, files, dirs)
+
+        for dirname in dirs:
+            subdir = os.path.join(dirpath, dirname)
+            try:
+                stack.append((subdir, prefix + dirname + '/', os.stat(subdir).st_mtime))
+            except OSError:
+                pass
+
+    _saveManifest(dataset, manifest, updated, [dir_ for dir_ in oldManifest if dir_ not in manifest])
+    return manifest
+
+def _scanDataSet(dataSetKey, cachedRunCtimes):
+    # walk dataSetKey once and return
+    #   runStats:     {subpath: (st_size, st_ctime)} of all .cali and .json files
+    #   newRuns:      subpaths that are new or changed since cachedRunCtimes
+    #   jsonSubpaths: all .json subpaths
+    #   deletedRuns:  cached subpaths that no longer exist
+    runStats = {}
+    newRuns = []
+    jsonSubpaths = []
+    remaining = dict(cachedRunCtimes)
+
+    for (prefix, (_, files, _)) in _walkDataSet(dataSetKey).items():
+        for (fname, stat) in files.items():
+            runKey = prefix + fname
+            runStats[runKey] = stat
+            if stat[1] > remaining.pop(runKey, 0):
+                newRuns.append(runKey)
+            if fname.endswith('.json'):
+                jsonSubpaths.append(runKey)
+
+    return (runStats, newRuns, jsonSubpaths, list(remaining))
+
+
+# directory digests.  Instead of the ctime of every run it has, a client can
+# send back the digest of each directory's listing from its last getData.
+# Directories whose digest is unchanged are skipped without looking at their
+# runs; changed ones are compared with the listing the old digest was computed
+# from, which is kept in the run cache by digest.
+
+def _dirDigest(files):
+    return hashlib.sha1(json.dumps(sorted(files.items())).encode('utf-8')).hexdigest()[:20]
+
+def _loadDirSnapshots(digests):
+    import sqlite3
+    snapshots = {}
+    with _RUN_CACHE_LOCK:
+        db = _runCache()
+        if not db or not digests:
+            return snapshots
+        try:
+            for digest in set(digests):
+                row = db.execute('SELECT files FROM DirSnapshots WHERE digest = ?', (digest,)).fetchone()
+                if row:
+                    snapshots[digest] = json.loads(row[0])
+            db.executemany('UPDATE DirSnapshots SET atime = ? WHERE digest = ?', [(time.time(), digest) for digest in snapshots])
+        except sqlite3.Error:
+            pass
+    return snapshots
+
+def _saveDirSnapshots(snapshots):
+    import sqlite3
+    with _RUN_CACHE_LOCK:
+        db = _runCache()
+        if not db or not snapshots:
+            return
+        try:
+            db.execute('BEGIN')
+            db.executemany('INSERT OR REPLACE INTO DirSnapshots VALUES (?, ?, ?)',
+                           [(digest, json.dumps(files), time.time()) for (digest, files) in snapshots.items()])
+            # least recently used first
+            db.execute('DELETE FROM DirSnapshots WHERE digest IN'
+                       ' (SELECT digest FROM DirSnapshots ORDER BY atime DESC LIMIT -1 OFFSET ?)', (CONFIG['dir_snapshots'],))
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+
+def _scanDataSetDigests(dataSetKey, dirDigests):
+    # as _scanDataSet, against {dir prefix: digest} instead of {subpath: ctime}.  Also returns
+    #   resetDirs:  directories whose old listing is unknown; the client drops the runs
+    #               directly in them, the current ones are in newRuns
+    #   dirDigests: the current {dir prefix: digest}, to send back next time
+    manifest = _walkDataSet(dataSetKey)
+    digests = {prefix: _dirDigest(files) for (prefix, (_, files, _)) in manifest.items()}
+    changed = [prefix for prefix in manifest if dirDigests.get(prefix) != digests[prefix]]
+    gone = [prefix for prefix in dirDigests if prefix not in manifest]
+    snapshots = _loadDirSnapshots([dirDigests[prefix] for prefix in changed + gone if prefix in dirDigests])
+    _saveDirSnapshots({digests[prefix]: manifest[prefix][1] for prefix in changed})
+
+    runStats = {}
+    newRuns = []
+    jsonSubpaths = []
+    deletedRuns = []
+    resetDirs = []
+
+    for (prefix, (_, files, _)) in manifest.items():
+        for (fname, stat) in files.items():
+            runStats[prefix + fname] = stat
+            if fname.endswith('.json'):
+                jsonSubpaths.append(prefix + fname)
+
+    for prefix in changed + gone:
+        files = manifest[prefix][1] if prefix in manifest else {}
+        if prefix not in dirDigests:
+            oldFiles = {}
+        elif dirDigests[prefix] in snapshots:
+            oldFiles = snapshots[dirDigests[prefix]]
+        else:
+            oldFiles = {}
+            resetDirs.append(prefix)
+        for (fname, stat) in files.items():
+            if list(oldFiles.get(fname, ())) != list(stat):
+                newRuns.append(prefix + fname)
+        deletedRuns.extend(prefix + fname for fname in oldFiles if fname not in files)
+
+    return (runStats, newRuns, jsonSubpaths, deletedRuns, resetDirs, digests)
+
+def _digestsWithout(digests, runStats, subpaths):
+    # take subpaths (files that failed to parse) out of the digests of their
+    # directories, so they compare as new in the next request
+    prefixes = {subpath[:subpath.rfind('/') + 1] for subpath in subpaths}
+    listings = {prefix: {} for prefix in prefixes if prefix in digests}
+    for (subpath, stat) in runStats.items():
+        prefix = subpath[:subpath.rfind('/') + 1]
+        if prefix in listings and subpath not in subpaths:
+            listings[prefix][subpath[len(prefix):]] = stat
+    snapshots = {}
+    for (prefix, files) in listings.items():
+        digests[prefix] = _dirDigest(files)
+        snapshots[digests[prefix]] = files
+    _saveDirSnapshots(snapshots)
+
+
+def _writeLine(out, obj):
+    # one compact json document per line, flushed by the caller
+    out.write(json.dumps(obj, separators=(',', ':')))
+    out.write('\n')
+
+def _dictEncode(values):
+    # [v0, v1, v0, None] -> {'values': [v0, v1], 'codes': [0, 1, 0, -1]}
+    table = {}
+    uniques = []
+    codes = []
+    for val in values:
+        if val is None:
+            codes.append(-1)
+            continue
+        key = val if isinstance(val, (str, int, float)) else json.dumps(val, sort_keys=True)
+        code = table.get(key)
+        if code is None:
+            code = table[key] = len(uniques)
+            uniques.append(val)
+        codes.append(code)
+    return {'values': uniques, 'codes': codes}
+
+def _toColumnar(runs):
+    # Runs as columns: call paths and metric names are interned once, and
+    # entry i of Index.run/Index.path says which (run, path) row i of every
+    # metric column belongs to. Columns with non-numeric values and all
+    # globals are dictionary encoded.
+    runKeys = []
+    paths = {}
+    metrics = {}
+    columns = []
+    runIdx = []
+    pathIdx = []
+    globalColumns = {}
+
+    for (runKey, run) in runs:
+        r = len(runKeys)
+        runKeys.append(runKey)
+        for (funcpath, record) in run.get('Data', {}).items():
+            row = len(runIdx)
+            runIdx.append(r)
+            pathIdx.append(paths.setdefault(funcpath, len(paths)))
+            for (metricName, val) in record.items():
+                m = metrics.get(metricName)
+                if m is None:
+                    m = metrics[metricName] = len(columns)
+                    columns.append([])
+                col = columns[m]
+                if len(col) < row:
+                    col.extend([None] * (row - len(col)))
+                col.append(val)
+        for (global_, val) in run['Globals'].items():
+            col = globalColumns.setdefault(global_, [])
+            if len(col) < r:
+                col.extend([None] * (r - len(col)))
+            col.append(val)
+
+    for col in columns:
+        col.extend([None] * (len(runIdx) - len(col)))
+    for col in globalColumns.values():
+        col.extend([None] * (len(runKeys) - len(col)))
+
+    return { 'RunKeys': runKeys
+           , 'Paths': list(paths)
+           , 'Metrics': list(metrics)
+           , 'Index': {'run': runIdx, 'path': pathIdx}
+           , 'Values': [_dictEncode(col) if any(isinstance(val, str) for val in col) else col for col in columns]
+           , 'Globals': {global_: _dictEncode(col) for (global_, col) in globalColumns.items()}
+           }
+
+def _writeOutput(out, format_, runs, meta, trailer):
+    # runs is consumed before meta is read, so meta may be filled in while runs are produced
+    if format_ == 'columnar':
+        output = {'Format': 'columnar'}
+        output.update(_toColumnar(runs or ()))
+        output.update(meta)
+        output.update(trailer)
+        json.dump(output, out, separators=(',', ':'))
+    elif format_ == 'ndjson':
+        if runs is not None:
+            # flushed in batches: a run producer that is slow still streams,
+            # without every run becoming its own write (or its own chunk in serve)
+            for (i, (runKey, run)) in enumerate(runs, 1):
+                _writeLine(out, dict(Run=runKey, **run))
+                if i % 64 == 0:
+                    out.flush()
+        for part in (meta, trailer):
+            for (name, value) in part.items():
+                _writeLine(out, {name: value})
+        out.flush()
+    else:
+        output = {}
+        if runs is not None:
+            output['Runs'] = dict(runs)
+        output.update(meta)
+        output.update(trailer)
+        json.dump(output, out, indent=4)
+
+
+# normalized database written by `ingest`: one row per run, global, call path,
+# metric and (run, path, metric) value, so queries need no json decoding.
+# Lives next to the Runs/Metadata tables in any SQLite file
+_INGEST_SCHEMA = [ 'CREATE TABLE IF NOT EXISTS spot_runs (id INTEGER PRIMARY KEY, run_key TEXT UNIQUE NOT NULL, ctime REAL, size INTEGER)'
+                 , 'CREATE TABLE IF NOT EXISTS spot_globals (run INTEGER NOT NULL, name TEXT NOT NULL, value, type TEXT, PRIMARY KEY (run, name)) WITHOUT ROWID'
+                 , 'CREATE INDEX IF NOT EXISTS spot_globals_name_value ON spot_globals (name, value)'
+                 , 'CREATE TABLE IF NOT EXISTS spot_paths (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, depth INTEGER NOT NULL)'
+                 , 'CREATE TABLE IF NOT EXISTS spot_metrics (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, type TEXT)'
+                 , 'CREATE TABLE IF NOT EXISTS spot_values (run INTEGER NOT NULL, path INTEGER NOT NULL, metric INTEGER NOT NULL, value, PRIMARY KEY (run, path, metric)) WITHOUT ROWID'
+                 , 'CREATE INDEX IF NOT EXISTS spot_values_metric ON spot_values (metric, path)'
+                 ]
+
+def _isIngestedDB(dbFilepath):
+    if not dbFilepath.endswith('.sqlite'):
+        return False
+    with _DBConnection(dbFilepath) as (cursor, _):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'spot_runs'")
+        return bool(cursor.fetchall())
+
+def _ingestedRunCtimes(dbFilepath):
+    with _DBConnection(dbFilepath) as (cursor, _):
+        cursor.execute('SELECT run_key, ctime FROM spot_runs')
+        return dict(_fetchRows(cursor))
+
+def _iterIngestedRuns(dbFilepath, runKeys, meta, runFilter=_NO_FILTER, batchSize=100, summary=False):
+    # yields (runKey, {Globals, Data}) for the given runs of an ingested
+    # database, fetched a batch of runs per query; fills in meta as it goes.
+    # summary: only {Globals}
+    runDataMeta = meta.setdefault('RunDataMeta', {})
+    runGlobalMeta = meta.setdefault('RunGlobalMeta', {})
+    (runClauses, runParams) = runFilter.sqlIngestedWhere()
+    (valueClauses, valueParams) = runFilter.sqlIngestedProjection()
+
+    with _DBConnection(dbFilepath) as (cursor, _):
+        cursor.execute('SELECT name, type FROM spot_metrics')
+        metricTypes = dict(_fetchRows(cursor))
+
+        for i in range(0, len(runKeys), batchSize):
+            batch = runKeys[i:i+batchSize]
+            cursor.execute(' AND '.join(['SELECT id, run_key FROM spot_runs WHERE run_key IN ({})'.format(', '.join(['?'] * len(batch)))] + runClauses),
+                           list(batch) + runParams)
+            keys = dict(_fetchRows(cursor))
+            if not keys:
+                continue
+            runs = {runId: {'Globals': {}} if summary else {'Globals': {}, 'Data': {}} for runId in keys}
+            inIds = 'IN ({})'.format(', '.join(['?'] * len(keys)))
+
+            cursor.execute('SELECT run, name, value, type FROM spot_globals WHERE run ' + inIds, list(keys))
+            for (runId, name, value, type_) in _fetchRows(cursor):
+                runs[runId]['Globals'][name] = value
+                if type_:
+                    runGlobalMeta[name] = {'type': type_}
+
+            if summary:
+                yield from ((keys[runId], run) for (runId, run) in runs.items())
+                continue
+
+            cursor.execute(' AND '.join(['SELECT v.run, p.path, m.name, v.value FROM spot_values v'
+                                         ' JOIN spot_paths p ON p.id = v.path JOIN spot_metrics m ON m.id = v.metric'
+                                         ' WHERE v.run ' + inIds] + valueClauses) + ' ORDER BY v.run, v.path, v.metric',
+                           list(keys) + valueParams)
+            for (runId, funcpath, metricName, value) in _fetchRows(cursor):
+                runs[runId]['Data'].setdefault(funcpath, {})[metricName] = value
+                if metricName not in runDataMeta:
+                    runDataMeta[metricName] = {'type': metricTypes[metricName]}
+
+            for (runId, run) in runs.items():
+                yield (keys[runId], run)
+
+def ingest(args, out=sys.stdout):
+    # load the .cali runs of a directory into the spot_* tables of a SQLite
+    # database. Runs whose ctime has not changed since the last ingest are
+    # skipped; changed and deleted files are replaced and removed
+    import sqlite3
+    db = sqlite3.connect(args.db, isolation_level=None)
+    for statement in _INGEST_SCHEMA:
+        db.execute(statement)
+
+    ingested = dict(db.execute('SELECT run_key, ctime FROM spot_runs'))
+    (runStats, newRuns, _, deletedRuns) = _scanDataSet(args.directory, ingested)
+    newRuns = [runKey for runKey in newRuns if runKey.endswith('.cali')]
+    paths = dict(db.execute('SELECT path, id FROM spot_paths'))
+    metrics = dict(db.execute('SELECT name, id FROM spot_metrics'))
+    meta = {}
+
+    def transaction(func, *args_):
+        db.execute('BEGIN')
+        try:
+            func(*args_)
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def delete(runKeys):
+        for i in range(0, len(runKeys), 500):
+            batch = runKeys[i:i+500]
+            ids = 'SELECT id FROM spot_runs WHERE run_key IN ({})'.format(', '.join(['?'] * len(batch)))
+            for table in ('spot_values', 'spot_globals'):
+                db.execute('DELETE FROM {} WHERE run IN ({})'.format(table, ids), batch)
+            db.execute('DELETE FROM spot_runs WHERE run_key IN ({})'.format(', '.join(['?'] * len(batch))), batch)
+
+    def insert(runs):
+        for (runKey, run) in runs:
+            (size, ctime) = runStats[runKey]
+            runId = db.execute('INSERT INTO spot_runs (run_key, ctime, size) VALUES (?, ?, ?)', (runKey, ctime, size)).lastrowid
+            db.executemany('INSERT INTO spot_globals VALUES (?, ?, ?, ?)',
+                           [( runId
+                            , name
+                            , val if isinstance(val, (str, int, float)) or val is None else json.dumps(val)
+                            , meta['RunGlobalMeta'].get(name, {}).get('type')
+                            ) for (name, val) in run['Globals'].items()])
+            values = []
+            for (funcpath, record) in run['Data'].items():
+                p = paths.get(funcpath)
+                if p is None:
+                    p = paths[funcpath] = db.execute('INSERT INTO spot_paths (path, depth) VALUES (?, ?)', (funcpath, funcpath.count('/') + 1)).lastrowid
+                for (metricName, val) in record.items():
+                    m = metrics.get(metricName)
+                    if m is None:
+                        m = metrics[metricName] = db.execute('INSERT INTO spot_metrics (name, type) VALUES (?, ?)',
+                                                             (metricName, meta['RunDataMeta'].get(metricName, {}).get('type'))).lastrowid
+                    values.append((runId, p, m, val))
+            db.executemany('INSERT INTO spot_values VALUES (?, ?, ?, ?)', values)
+
+    # changed runs are deleted first: if the ingest is interrupted they are missing, and picked up by the next one
+    transaction(delete, deletedRuns + [runKey for runKey in newRuns if runKey in ingested])
+
+    count = 0
+    batch = []
+    for item in _iterCaliRuns(args.directory, newRuns, runStats, meta):
+        batch.append(item)
+        if len(batch) == args.batchSize:
+            transaction(insert, batch)
+            count += len(batch)
+            batch = []
+    transaction(insert, batch)
+    count += len(batch)
+    db.close()
+
+    json.dump({ 'ingested': count
+              , 'deleted': len(deletedRuns)
+              , 'failedRuns': meta.get('failedRuns', {})
+              }, out, indent=4)
+
+
+# matrix store.  export writes the runs of a directory or database into a
+# directory of arrays numpy maps without parsing any run:
+#   paths.json    [path]: column j of the matrices
+#   runs.json     [{Run, Globals}]: row i of the matrices
+#   <metric>.npy  runs x paths of one numeric metric, NaN where a run has no value
+#   store.json    {Source, Runs, Paths, DType, Metrics: {metric: file}, Filter, State, ..}
+# The matrices can be larger than store.json counts: columns are allocated
+# ahead of the paths, and an interrupted export leaves rows behind. store.json
+# is written last; readers slice [:Runs, :Paths], see _loadMatrixStore.
+
+_MATRIX_STORE = 'store.json'
+
+def _isMatrixStore(dataSetKey):
+    return os.path.isfile(os.path.join(dataSetKey, _MATRIX_STORE))
+
+def _writeStoreFile(filepath, obj):
+    tmp = '{}.{}.tmp'.format(filepath, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, separators=(',', ':'))
+    os.replace(tmp, filepath)
+
+def _loadMatrixStore(storeDir, metrics=None):
+    # (store, runs, paths, {metric: read-only runs x paths memmap})
+    import numpy as np
+    with open(os.path.join(storeDir, _MATRIX_STORE)) as f:
+        store = json.load(f)
+    with open(os.path.join(storeDir, 'runs.json')) as f:
+        runs = json.load(f)[:store['Runs']]
+    with open(os.path.join(storeDir, 'paths.json')) as f:
+        paths = json.load(f)[:store['Paths']]
+    matrices = {metricName: np.load(os.path.join(storeDir, fname), mmap_mode='r')[:store['Runs'], :store['Paths']]
+                for (metricName, fname) in store['Metrics'].items() if not metrics or metricName in metrics}
+    return (store, runs, paths, matrices)
+
+def _resizeMatrix(filepath, shape, dtype, keepRows=None):
+    # grow the .npy at filepath to at least shape, filling with NaN, or create it.
+    # Rows are appended in place; more columns, or keepRows (the rows to keep,
+    # in order), rewrite the file
+    import numpy as np
+    fmt = np.lib.format
+    if os.path.exists(filepath) and keepRows is None:
+        old = np.load(filepath, mmap_mode='r')
+        (oldRows, oldCols) = old.shape
+        offset = old.offset
+        del old
+        if oldCols >= shape[1] and oldRows >= shape[0]:
+            return
+        if oldCols >= shape[1]:
+            header = io.BytesIO()
+            fmt.write_array_header_1_0(header, {'descr': fmt.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (shape[0], oldCols)})
+            # the header is padded, so it keeps its size unless the shape gains several digits
+            if len(header.getvalue()) == offset:
+                with open(filepath, 'r+b') as f:
+                    f.seek(offset + oldRows * oldCols * np.dtype(dtype).itemsize)
+                    np.full((shape[0] - oldRows, oldCols), np.nan, dtype=dtype).tofile(f)
+                    f.seek(0)
+                    f.write(header.getvalue())
+                return
+
+    tmp = '{}.{}.tmp'.format(filepath, os.getpid())
+    try:
+        if not os.path.exists(filepath):
+            new = fmt.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+            new[:] = np.nan
+        else:
+            old = np.load(filepath, mmap_mode='r')
+            rows = np.arange(old.shape[0]) if keepRows is None else np.asarray(keepRows, dtype=np.intp)
+            shape = (max(shape[0], len(rows)), max(shape[1], old.shape[1]))
+            new = fmt.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+            new[:] = np.nan
+            for i in range(0, len(rows), 1024):
+                chunk = rows[i:i+1024]
+                new[i:i+len(chunk), :old.shape[1]] = old[chunk]
+            del old
+        new.flush()
+        del new
+        os.replace(tmp, filepath)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def export(args, out=sys.stdout):
+    # write the runs of a directory or database into the matrix store
+    # storeDir, or add the runs that are new or changed since the last export
+    import numpy as np
+    storeDir = args.storeDir
+    storePath = os.path.join(storeDir, _MATRIX_STORE)
+    filter_ = {'metrics': args.metrics, 'pathPrefix': args.pathPrefix, 'maxDepth': args.maxDepth, 'where': args.where}
+    if os.path.exists(storePath):
+        (store, runs, paths, _) = _loadMatrixStore(storeDir)
+        if store['Source'] != os.path.abspath(args.dataSetKey):
+            raise ValueError('{} was exported from {}'.format(storeDir, store['Source']))
+        if any(filter_.values()) and filter_ != store['Filter']:
+            raise ValueError('{} was exported with {}'.format(storeDir, json.dumps(store['Filter'])))
+    else:
+        os.makedirs(storeDir, exist_ok=True)
+        store = { 'Source': os.path.abspath(args.dataSetKey)
+                , 'Runs': 0
+                , 'Paths': 0
+                , 'DType': args.dtype
+                , 'Metrics': {}
+                , 'Filter': filter_
+                , 'State': {}
+                , 'RunGlobalMeta': {}
+                , 'RunDataMeta': {}
+                }
+        runs = []
+        paths = []
 
+    dataSetKey = args.dataSetKey
+    runFilter = _RunFilter.fromArgs(argparse.Namespace(**store['Filter']))
+    state = store['State']
+    meta = {}
+    deletedRuns = []
+    staleRuns = []
+    if _isIngestedDB(dataSetKey):
+        runCtimes = _ingestedRunCtimes(dataSetKey)
+        cachedRunCtimes = state.get('RunCtimes', {})
+        deletedRuns = [runKey for runKey in cachedRunCtimes if runKey not in runCtimes]
+        newRuns = [runKey for (runKey, ctime) in runCtimes.items() if ctime > cachedRunCtimes.get(runKey, 0)]
+        newIter = _iterIngestedRuns(dataSetKey, newRuns, meta, runFilter)
+        state = {'RunCtimes': runCtimes}
+    elif dataSetKey.endswith(('.yaml', '.sqlite')):
+        newIter = _iterDatabaseRuns(dataSetKey, state.get('LastRead', 0), meta, runFilter)
+    else:
+        (runStats, newRuns, _, deletedRuns) = _scanDataSet(dataSetKey, state.get('RunCtimes', {}))
+        # {subpath: [runKey]} of the exported .json run sets: the runs of deleted
+        # and changed sets go, unless they are read again
+        runSets = state.get('RunSets', {})
+        newJson = [subpath for subpath in newRuns if subpath.endswith('.json')]
+        staleRuns = [runKey for subpath in deletedRuns + newJson for runKey in runSets.pop(subpath, [])]
+        newIter = itertools.chain( _iterJsonRuns(dataSetKey, newJson, runStats, meta, runFilter, runSets=runSets)
+                                 , _iterCaliRuns(dataSetKey, [subpath for subpath in newRuns if subpath.endswith('.cali')], runStats, meta, runFilter=runFilter)
+                                 )
+        state = {'RunCtimes': {runKey: stat[1] for (runKey, stat) in runStats.items()}, 'RunSets': runSets}
+
+    dtype = store['DType']
+    rowOf = {run['Run']: i for (i, run) in enumerate(runs)}
+    colOf = {funcpath: j for (j, funcpath) in enumerate(paths)}
+
+    def metricFile(metricName):
+        fname = store['Metrics'].get(metricName)
+        if fname is None:
+            base = re.sub(r'[^\w.#-]+', '_', metricName)
+            fname = base + '.npy'
+            taken = set(store['Metrics'].values())
+            while fname in taken:
+                fname = '{}-{}.npy'.format(base, len(taken))
+                taken.add(fname)
+            store['Metrics'][metricName] = fname
+        return os.path.join(storeDir, fname)
+
+    changedRuns = [runKey for runKey in newRuns if runKey in rowOf] + staleRuns if 'RunCtimes' in state else []
+    added = 0
+    updated = 0
+    lastRead = state.get('LastRead', 0)
+    batch = []
+    seen = set()
+
+    def write(batch):
+        # one dense (batch x paths) block per metric, written into its rows
+        nonlocal added, updated
+        rows = []
+        entries = {}
+            # {metric: (batch rows, cols, vals)}
+        for (b, (runKey, run)) in enumerate(batch):
+            seen.add(runKey)
+            r = rowOf.get(runKey)
+            if r is None:
+                r = rowOf[runKey] = len(runs)
+                runs.append({'Run': runKey, 'Globals': run['Globals']})
+                added += 1
+            else:
+                runs[r] = {'Run': runKey, 'Globals': run['Globals']}
+                updated += 1
+            rows.append(r)
+            for (funcpath, record) in run['Data'].items():
+                p = colOf.get(funcpath)
+                if p is None:
+                    p = colOf[funcpath] = len(paths)
+                    paths.append(funcpath)
+                for (metricName, val) in record.items():
+                    if isinstance(val, bool) or not isinstance(val, (int, float)):
+                        continue
+                    (bs, cols, vals) = entries.setdefault(metricName, ([], [], []))
+                    bs.append(b)
+                    cols.append(p)
+                    vals.append(val)
+
+        rows = np.array(rows, dtype=np.intp)
+        # columns grow by half at a time, so adding paths rarely rewrites the matrices
+        for metricName in list(store['Metrics']) + [m for m in entries if m not in store['Metrics']]:
+            filepath = metricFile(metricName)
+            capacity = len(paths)
+            if os.path.exists(filepath):
+                cols = np.load(filepath, mmap_mode='r').shape[1]
+                capacity = cols if cols >= len(paths) else max(len(paths), cols + cols // 2)
+            _resizeMatrix(filepath, (len(runs), capacity), dtype)
+            matrix = np.load(filepath, mmap_mode='r+')
+            # whole rows, over anything an interrupted export left there
+            block = np.full((len(batch), matrix.shape[1]), np.nan, dtype=dtype)
+            if metricName in entries:
+                (bs, cols, vals) = entries[metricName]
+                block[np.array(bs, dtype=np.intp), np.array(cols, dtype=np.intp)] = vals
+            matrix[rows] = block
+            matrix.flush()
+            del matrix
+
+    for (runKey, run) in newIter:
+        if isinstance(runKey, int):
+            lastRead = max(lastRead, runKey)
+        batch.append((runKey, run))
+        if len(batch) == args.batchSize:
+            write(batch)
+            batch = []
+    if batch:
+        write(batch)
+    # runs that failed are not recorded, so the next export reads them again.
+    # A changed run that failed is not seen, and its old row goes below
+    for runKey in meta.get('failedRuns', {}):
+        state.get('RunCtimes', {}).pop(runKey, None)
+
+    # deleted runs, and changed runs that the filter no longer selects, are
+    # compacted away. Unlike adding runs this moves rows: a store whose export
+    # is interrupted here has to be exported again from scratch
+    deleted = (set(deletedRuns) | set(changedRuns) - seen) & set(rowOf)
+    if deleted:
+        keepRows = [i for (i, run) in enumerate(runs) if run['Run'] not in deleted]
+        for metricName in store['Metrics']:
+            _resizeMatrix(metricFile(metricName), (len(keepRows), len(paths)), dtype, keepRows)
+        runs = [runs[i] for i in keepRows]
+
+    if 'LastReadPosix' in meta.get('RunSetMeta', {}):
+        state = {'LastRead': max(lastRead, meta['RunSetMeta']['LastReadPosix'])}
+    store['RunGlobalMeta'].update(meta.get('RunGlobalMeta', {}))
+    store['RunDataMeta'].update(meta.get('RunDataMeta', {}))
+    store.update({'Runs': len(runs), 'Paths': len(paths), 'State': state})
+    _writeStoreFile(os.path.join(storeDir, 'runs.json'), runs)
+    _writeStoreFile(os.path.join(storeDir, 'paths.json'), paths)
+    _writeStoreFile(storePath, store)
+
+    json.dump({ 'added': added
+              , 'updated': updated
+              , 'deleted': len(deleted)
+              , 'runs': len(runs)
+              , 'paths': len(paths)
+              , 'metrics': len(store['Metrics'])
+              , 'failedRuns': meta.get('failedRuns', {})
+              }, out, indent=4)
+
+
+def _readClientState(arg):
+    # json, '-' to read it from stdin or '@path' from a file: large states do not fit in argv
+    if arg == '-':
+        if _SERVING:
+            raise ValueError("cannot read the client state from stdin when serving, use @path")
+        text = sys.stdin.read()
+    elif arg.startswith('@'):
+        with open(arg[1:]) as f:
+            text = f.read()
+    else:
+        text = arg
+    return json.loads(text) if text.strip() else {}
 
-def getData(args):
+def getData(args, out=sys.stdout):
     dataSetKey = args.dataSetKey
     lastRead = args.lastRead or 0
-    cachedRunCtimes = json.loads(args.cachedRunCtimes)
-        # {subpath: cachedCtime}
-
-    output = {}
+    clientState = _readClientState(args.cachedRunCtimes)
+        # {subpath: cachedCtime}, or {"dirDigests": {dir prefix: digest}} for directories
+    dirDigests = clientState.get('dirDigests') if isinstance(clientState.get('dirDigests'), dict) else None
+    cachedRunCtimes = {} if dirDigests is not None else clientState
+
+    runs = None
+    meta = {}
+    trailer = {}
+    prof = _profile()
+    runFilter = _RunFilter.fromArgs(args)
+    # summary: globals only, for a first paint. runKeys: fetch the data of these runs later on
+    summary = args.summary
+    runKeys = json.loads(args.runKeys) if args.runKeys else None
+    # shard: only handle partition i of n, see merge
+    shard = _parseShard(args.shard)
+    inShard = lambda runKey: shard is None or _inShard(runKey, shard)
+
+    # database written by ingest: incremental like a directory
+    if _isIngestedDB(dataSetKey):
+        runCtimes = {runKey: ctime for (runKey, ctime) in _ingestedRunCtimes(dataSetKey).items() if inShard(runKey)}
+        if runKeys is None:
+            newRuns = [runKey for (runKey, ctime) in runCtimes.items() if ctime > cachedRunCtimes.get(runKey, 0)]
+        else:
+            newRuns = [runKey for runKey in runKeys if runKey in runCtimes]
+        runs = _iterIngestedRuns(dataSetKey, newRuns, meta, runFilter, summary=summary)
+        trailer['deletedRuns'] = [runKey for runKey in cachedRunCtimes if runKey not in runCtimes and inShard(runKey)]
+        trailer['runCtimes'] = runCtimes
 
     # sql database
-    if dataSetKey.endswith(('.yaml', '.sqlite')):
-        output = _getAllDatabaseRuns(dataSetKey, lastRead)
+    elif dataSetKey.endswith(('.yaml', '.sqlite')):
+        runs = _iterDatabaseRuns(dataSetKey, lastRead, meta, runFilter, summary, runKeys, shard)
 
     # file directory
     else:
         lastReadTime = float(lastRead)
 
         # get subpaths of data files that were added since last read time
-        newRuns = []
-        jsonSubpaths = []
-        runCtimes = {}
-        for (dirpath, dirnames, filenames) in os.walk(dataSetKey):
-            for fname in filenames:
-                fp = os.path.join(dirpath, fname)
-                newCtime = os.stat(fp).st_ctime
-                dataSetKey = dataSetKey.rstrip('/')
-
-                splitKey = dataSetKey + '/'
-                runSpli = fp.split( splitKey )
-                len_el = len(runSpli)
-
-                #print("len = " + str(len_el))
-
-                if 1 < len_el:
-                	runKey = runSpli[1]
+        with prof.phase('scan') as stats:
+            if dirDigests is None:
+                (runStats, newRuns, jsonSubpaths, deletedRuns) = _scanDataSet(dataSetKey, cachedRunCtimes)
+            else:
+                (runStats, newRuns, jsonSubpaths, deletedRuns, resetDirs, digests) = _scanDataSetDigests(dataSetKey, dirDigests)
+            stats['count'] = len(runStats) + len(jsonSubpaths)
+        allRunStats = runStats
+        if runKeys is not None:
+            # the runs of a .json run set are not keyed by its subpath: read every set for them
+            newRuns = [runKey for runKey in runKeys if runKey in runStats] + jsonSubpaths
+        if shard:
+            runStats = {runKey: stat for (runKey, stat) in runStats.items() if inShard(runKey)}
+            newRuns = [runKey for runKey in newRuns if inShard(runKey)]
+            deletedRuns = [runKey for runKey in deletedRuns if inShard(runKey)]
+        runCtimes = {runKey: stat[1] for (runKey, stat) in runStats.items()}
+        newJson = [subpath for subpath in newRuns if subpath.endswith('.json')]
+        newCali = [subpath for subpath in newRuns if subpath.endswith('.cali')]
+        runSets = {}
+
+        def dirRuns():
+            # both formats in one payload, their metadata collected into the same meta
+            yield from _iterJsonRuns(dataSetKey, newJson, runStats, meta, runFilter, summary, runSets, runKeys)
+            yield from _iterCaliRuns(dataSetKey, newCali, runStats, meta, runFilter=runFilter, summary=summary)
+            # the trailer is written after the runs: files that failed are left out of
+            # it, so the client asks for them again instead of taking them as read
+            for subpath in meta['failedRuns']:
+                runCtimes.pop(subpath, None)
+            if dirDigests is not None and meta['failedRuns']:
+                _digestsWithout(digests, allRunStats, meta['failedRuns'])
+        if newRuns:
+            runs = dirRuns()
+
+        # a run set is tracked by its subpath: when that is deleted, or its runs
+        # are sent again, the client drops the runs it got for the set before
+        trailer['runSets'] = runSets
+        trailer['deletedRuns'] = deletedRuns
+        if dirDigests is None:
+            trailer['runCtimes'] = runCtimes
+        else:
+            trailer['resetDirs'] = resetDirs
+            trailer['dirDigests'] = digests
+
+    # runs are produced while they are written: 'runs' is the time spent
+    # producing them, 'dump' the rest of the time spent writing the output
+    if runs is not None:
+        runs = prof.timed('runs', runs)
+    start = time.perf_counter()
+    _writeOutput(out, args.format, runs, meta, trailer)
+    prof.add('dump', time.perf_counter() - start - prof.phases.get('runs', {}).get('seconds', 0.0))
+
+
+def _parseShard(shard):
+    # 'i/n' -> (i, n)
+    if not shard:
+        return None
+    try:
+        (i, n) = [int(part) for part in shard.split('/')]
+    except ValueError:
+        raise ValueError('invalid shard {}: expected i/n'.format(shard))
+    if not 0 <= i < n:
+        raise ValueError('invalid shard {}: expected 0 <= i < n'.format(shard))
+    return (i, n)
+
+def _inShard(runKey, shard):
+    # stable across processes and machines, unlike hash()
+    return zlib.crc32(str(runKey).encode('utf-8')) % shard[1] == shard[0]
+
+def _iterShardOutput(filepath, meta, trailer):
+    # yields the runs of a json or ndjson getData output, merging its metadata into meta and trailer
+    def mergePart(name, value):
+        part = trailer if name in ('deletedRuns', 'runCtimes', 'resetDirs', 'dirDigests', 'runSets') else meta
+        if name == 'Format':
+            raise ValueError('{}: columnar output cannot be merged, use json or ndjson shards'.format(filepath))
+        elif name == 'RunSetMeta':
+            old = part.setdefault(name, {})
+            old['LastReadPosix'] = max(old.get('LastReadPosix', 0), value.get('LastReadPosix', 0))
+        elif isinstance(value, dict):
+            part.setdefault(name, {}).update(value)
+        elif isinstance(value, list):
+            old = part.setdefault(name, [])
+            old.extend(value)
+        else:
+            part[name] = value
+
+    with open(filepath) as f:
+        first = f.readline()
+        f.seek(0)
+        try:
+            # a json document spans several lines, ndjson has one per line
+            json.loads(first)
+            ndjson = True
+        except ValueError:
+            ndjson = False
+
+        if ndjson:
+            for line in f:
+                if not line.strip():
+                    continue
+                obj = json.loads(line)
+                if 'Run' in obj:
+                    runKey = obj.pop('Run')
+                    yield (runKey, obj)
                 else:
-                        print( "I cannot split this filename: " + fp + " with splitKey = " + splitKey )
-                        exit()
+                    for (name, value) in obj.items():
+                        mergePart(name, value)
+        else:
+            output = json.load(f)
+            runs = output.pop('Runs', None) or {}
+            for (name, value) in output.items():
+                mergePart(name, value)
+            yield from runs.items()
+
+def merge(args, out=sys.stdout):
+    # combine the outputs of getData --shard i/n into the output of a single getData
+    meta = {}
+    trailer = {}
+
+    def runs():
+        for filepath in args.shardOutputs:
+            yield from _iterShardOutput(filepath, meta, trailer)
+        for name in ('deletedRuns', 'resetDirs'):
+            if name in trailer:
+                trailer[name] = list(dict.fromkeys(trailer[name]))
+
+    _writeOutput(out, args.format, runs(), meta, trailer)
+
+
+def _iterDataSetRuns(dataSetKey, meta, runFilter=_NO_FILTER, runKeys=None):
+    # every run of a directory or database, or the runs in runKeys, that
+    # runFilter selects as (runKey, {Globals, Data}); the run meta is
+    # collected into meta while the runs are read
+    if _isIngestedDB(dataSetKey):
+        return _iterIngestedRuns(dataSetKey, runKeys or list(_ingestedRunCtimes(dataSetKey)), meta, runFilter)
+    if dataSetKey.endswith(('.yaml', '.sqlite')):
+        return _iterDatabaseRuns(dataSetKey, 0, meta, runFilter, runIds=runKeys)
+
+    (runStats, _, jsonSubpaths, _) = _scanDataSet(dataSetKey, {})
+    caliKeys = [runKey for runKey in (runStats if runKeys is None else runKeys) if runKey in runStats and runKey.endswith('.cali')]
+
+    def runs():
+        yield from _iterJsonRuns(dataSetKey, jsonSubpaths, runStats, meta, runFilter, runKeys=runKeys)
+        yield from _iterCaliRuns(dataSetKey, caliKeys, runStats, meta, runFilter=runFilter)
+    return runs()
+
+def _parseGroupBy(groupBy):
+    # 'commit,launchdate:86400' -> [('commit', None), ('launchdate', 86400.0)]
+    output = []
+    for item in filter(None, (groupBy or '').split(',')):
+        (global_, _, width) = item.partition(':')
+        output.append((global_, float(width) if width else None))
+    return output
 
-                if fname.endswith('.cali'):
-                    runCtimes[runKey] = newCtime
-                    if newCtime > cachedRunCtimes.get(runKey, 0):
-                        newRuns.append(runKey)
-                if fname.endswith('.json'):
-                        jsonSubpaths.append(runKey)
+def _groupKey(runGlobals, groupBy):
+    # values of the grouping globals, numeric ones floored to their bucket width
+    key = []
+    for (global_, width) in groupBy:
+        val = runGlobals.get(global_)
+        if width and val is not None:
+            try:
+                val = float(val) // width * width
+                val = int(val) if val == int(val) else val
+            except (TypeError, ValueError):
+                pass
+        key.append(val)
+    return tuple(key)
+
+def _runMatrices(runs, metrics=None):
+    # (runKeys, runGlobals, paths, {metric: matrix}) where every matrix is
+    # runs x paths, NaN where a run has no (numeric) value
+    import numpy as np
+
+    runKeys = []
+    runGlobals = []
+    paths = {}
+    entries = {}
+        # {metric: (rows, cols, vals)}
+    for (runKey, run) in runs:
+        r = len(runKeys)
+        runKeys.append(runKey)
+        runGlobals.append(run['Globals'])
+        for (funcpath, record) in run['Data'].items():
+            p = paths.setdefault(funcpath, len(paths))
+            for (metricName, val) in record.items():
+                if (metrics and metricName not in metrics) or isinstance(val, bool) or not isinstance(val, (int, float)):
+                    continue
+                (rows, cols, vals) = entries.setdefault(metricName, ([], [], []))
+                rows.append(r)
+                cols.append(p)
+                vals.append(val)
+
+    matrices = {}
+    for (metricName, (rows, cols, vals)) in entries.items():
+        matrix = np.full((len(runKeys), len(paths)), np.nan)
+        matrix[np.array(rows), np.array(cols)] = vals
+        matrices[metricName] = matrix
+    return (runKeys, runGlobals, list(paths), matrices)
+
+def _aggregateRuns(runs, groupBy, metrics, percentiles):
+    # per group of runs, {path: {metric: {count, mean, min, max, std, p<q>..}}}.
+    # Every metric becomes a (runs x paths) matrix with NaN where a run has no
+    # value, reduced along the run axis by the NaN-aware numpy functions
+    (_, runGlobals, pathNames, matrices) = _runMatrices(runs, metrics)
+    return _aggregateMatrices(runGlobals, pathNames, matrices, groupBy, percentiles)
+
+def _aggregateMatrices(runGlobals, pathNames, matrices, groupBy, percentiles):
+    import numpy as np
+    groups = {}
+        # {groupKey: [row]}
+    for (r, globals_) in enumerate(runGlobals):
+        groups.setdefault(_groupKey(globals_, groupBy), []).append(r)
+
+    output = []
+    for (key, rows) in groups.items():
+        rows = np.array(rows)
+        data = {}
+        for (metricName, matrix) in matrices.items():
+            sub = matrix[rows]
+            count = np.count_nonzero(~np.isnan(sub), axis=0)
+            # paths without a value in this group have no statistics
+            present = np.flatnonzero(count)
+            sub = sub[:, present]
+            columns = { 'count': count[present]
+                      , 'mean': np.nanmean(sub, axis=0)
+                      , 'min': np.nanmin(sub, axis=0)
+                      , 'max': np.nanmax(sub, axis=0)
+                      , 'std': np.nanstd(sub, axis=0)
+                      }
+            if percentiles and len(present):
+                for (q, col) in zip(percentiles, np.nanpercentile(sub, percentiles, axis=0)):
+                    columns['p{:g}'.format(q)] = col
+            columns = {name: col.tolist() for (name, col) in columns.items()}
+            for (i, p) in enumerate(present.tolist()):
+                data.setdefault(pathNames[p], {})[metricName] = {name: col[i] for (name, col) in columns.items()}
+        output.append({ 'Key': {global_: val for ((global_, _), val) in zip(groupBy, key)}
+                      , 'Runs': len(rows)
+                      , 'Data': data
+                      })
+    return output
 
-        deletedRuns = set(cachedRunCtimes.keys()).difference(set(runCtimes.keys()))
+def getAggregate(args, out=sys.stdout):
+    # cross-run statistics per call path and metric, so the front-end does not
+    # need to download every run to compute them
+    groupBy = _parseGroupBy(args.groupBy)
+    metrics = set(args.metrics.split(',')) if args.metrics else None
+    percentiles = [float(q) for q in args.percentiles.split(',') if q]
+
+    meta = {}
+    if _isMatrixStore(args.dataSetKey):
+        # an export: the matrices are mapped instead of built from the runs
+        (store, runs, pathNames, matrices) = _loadMatrixStore(args.dataSetKey, metrics)
+        groups = _aggregateMatrices([run['Globals'] for run in runs], pathNames, matrices, groupBy, percentiles)
+        meta = {'RunGlobalMeta': store['RunGlobalMeta'], 'RunDataMeta': store['RunDataMeta']}
+    else:
+        groups = _aggregateRuns(_iterDataSetRuns(args.dataSetKey, meta), groupBy, metrics, percentiles)
 
+    output = { 'GroupBy': [global_ for (global_, _) in groupBy]
+             , 'Groups': groups
+             }
+    output.update(meta)
+    json.dump(output, out, indent=4)
 
-        if jsonSubpaths:
-            output = _getAllJsonRuns(dataSetKey, jsonSubpaths)
-        if newRuns:
-            output = _getAllCaliRuns(dataSetKey, newRuns)
 
-        output['deletedRuns'] = list(deletedRuns)
-        output['runCtimes'] = runCtimes
+def _pathMeans(paths, matrices, allPaths):
+    # {metric: mean over the runs of every path in allPaths}, NaN where no run has a value
+    import numpy as np
+    cols = np.array([allPaths[funcpath] for funcpath in paths], dtype=np.intp)
+    output = {}
+    for (metricName, matrix) in matrices.items():
+        count = np.count_nonzero(~np.isnan(matrix), axis=0)
+        means = np.full(len(allPaths), np.nan)
+        means[cols] = np.where(count > 0, np.nansum(matrix, axis=0) / np.maximum(count, 1), np.nan)
+        output[metricName] = means
+    return output
+
+def _diffRuns(runsA, runsB, metrics, top):
+    # align the call paths of two sets of runs and compare the mean of each
+    # path on both sides: per metric, the paths ranked by absolute delta.
+    # A path missing on one side counts as 0 there and has no relative delta
+    import numpy as np
 
-    json.dump(output, sys.stdout, indent=4)
+    (keysA, _, pathsA, matricesA) = _runMatrices(runsA, metrics)
+    (keysB, _, pathsB, matricesB) = _runMatrices(runsB, metrics)
+    allPaths = {funcpath: i for (i, funcpath) in enumerate(dict.fromkeys(pathsA + pathsB))}
+    pathNames = np.array(list(allPaths), dtype=object)
+    meansA = _pathMeans(pathsA, matricesA, allPaths)
+    meansB = _pathMeans(pathsB, matricesB, allPaths)
+    missing = np.full(len(allPaths), np.nan)
+
+    output = {}
+    for metricName in sorted(set(meansA) | set(meansB)):
+        a = meansA.get(metricName, missing)
+        b = meansB.get(metricName, missing)
+        inA = ~np.isnan(a)
+        inB = ~np.isnan(b)
+        a0 = np.where(inA, a, 0.0)
+        b0 = np.where(inB, b, 0.0)
+        delta = b0 - a0
+        relative = np.where(inA & inB & (a0 != 0), delta / np.where(a0 != 0, a0, 1.0), np.nan)
+
+        present = np.flatnonzero(inA | inB)
+        order = present[np.argsort(-np.abs(delta[present]), kind='stable')]
+        if top:
+            order = order[:top]
+        output[metricName] = [ { 'path': funcpath
+                               , 'a': va if ia else None
+                               , 'b': vb if ib else None
+                               , 'delta': d
+                               , 'relative': r if r == r else None
+                               , 'onlyIn': None if ia and ib else ('a' if ia else 'b')
+                               }
+                               for (funcpath, va, vb, ia, ib, d, r)
+                               in zip(pathNames[order], a[order].tolist(), b[order].tolist(), inA[order].tolist(), inB[order].tolist(),
+                                      delta[order].tolist(), relative[order].tolist())
+                             ]
+    return ({'runs': keysA, 'paths': len(pathsA)}, {'runs': keysB, 'paths': len(pathsB)}, output)
+
+def getDiff(args, out=sys.stdout):
+    # compare two runs, or two sets of runs selected by their globals (e.g.
+    # commit A vs commit B), call path by call path
+    metrics = args.metrics.split(',') if args.metrics else None
+    sides = []
+    for (runKeys, where) in ((args.runA, args.whereA), (args.runB, args.whereB)):
+        if not (runKeys or where):
+            raise ValueError('getDiff needs --runA or --whereA, and --runB or --whereB')
+        meta = {}
+        sides.append(_iterDataSetRuns(args.dataSetKey, meta, _RunFilter(metrics, where=where or ()), runKeys))
+
+    (sideA, sideB, deltas) = _diffRuns(sides[0], sides[1], metrics, args.top)
+    if not sideA['runs'] or not sideB['runs']:
+        raise ValueError('no runs selected for side {}'.format('a' if not sideA['runs'] else 'b'))
+    json.dump({'A': sideA, 'B': sideB, 'Deltas': deltas}, out, indent=4)
 
 
 def getRun(runId, db=None):
     # sql database
     if db:
-        if db.endswith('.yaml'):
-            import yaml
-            import mysql.connector
-            dbConfig = yaml.load(open(db), Loader=yaml.FullLoader)
-            mydb = mysql.connector.connect(**dbConfig)
-            db_placeholder = "%s"
-        else:
-            import sqlite3
-            mydb = sqlite3.connect(db)
-            db_placeholder = "?"
+        return getRuns([runId], db)[runId]
+
+    # .cali file directory
+    else:
+        output = _cached('raw', runId, _getCaliRun)
+    return output
 
-        cursor = mydb.cursor()
+def getRuns(runIds, db=None):
+    # {runId: {records, globals}} for many runs. Database runs are fetched with
+    # one query per batch of ids instead of a round trip per run
+    if not db:
+        return {runId: getRun(runId) for runId in runIds}
+    if _isIngestedDB(db):
+        output = {}
+        for (runKey, run) in _iterIngestedRuns(db, [str(runId) for runId in runIds], {}):
+            output[runKey] = { 'records': [dict(record, path=funcpath) for (funcpath, record) in run['Data'].items()]
+                             , 'globals': run['Globals']
+                             }
+    else:
+        output = _getDatabaseRuns(runIds, db)
 
-        # get run
-        cursor.execute('SELECT globals, records FROM Runs Where run = ' + db_placeholder, (runId,))
-        rec = next(cursor)
-        runGlobals = json.loads(rec[0])
-        runData = json.loads(rec[1])
-        output = {'records': runData, 'globals': runGlobals}
+    # keep the caller's ids (e.g. '3' from the command line) and order
+    byId = {str(runNum): run for (runNum, run) in output.items()}
+    missing = [runId for runId in runIds if str(runId) not in byId]
+    if missing:
+        raise KeyError('runs not found: {}'.format(', '.join(map(str, missing))))
+    return {runId: byId[str(runId)] for runId in runIds}
 
-    # .cali file directory
+def _getDatabaseRuns(runIds, db):
+    output = {}
+    batchSize = 500
+    with _DBConnection(db) as (cursor, db_placeholder):
+        for i in range(0, len(runIds), batchSize):
+            batch = runIds[i:i+batchSize]
+            cursor.execute('SELECT run, globals, records FROM Runs Where run IN ({})'.format(', '.join([db_placeholder] * len(batch))), batch)
+            for (runNum, _globals, record) in _fetchRows(cursor):
+                output[runNum] = {'records': json.loads(record), 'globals': json.loads(_globals)}
+    return output
+
+def getRunsCmd(args, out=sys.stdout):
+    runs = getRuns(json.loads(args.runIds), args.db)
+    if args.format == 'ndjson':
+        for (runId, run) in runs.items():
+            _writeLine(out, dict(Run=runId, **run))
+    else:
+        json.dump(runs, out, indent=4)
+
+def getRunCmd(args, out=sys.stdout):
+    if args.root or args.maxDepth or args.metrics:
+        return _getRunSlice(args, out)
+    output = getRun(args.runId, args.db)
+    if args.format == 'ndjson':
+        for record in output['records']:
+            _writeLine(out, {'record': record})
+        _writeLine(out, {'globals': output['globals']})
+    else:
+        json.dump(output, out, indent=4)
+
+def _sliceRecords(records, runFilter):
+    # the records under runFilter's call path, with only its metrics
+    for record in records:
+        funcpath = record.get('path')
+        if funcpath is None:
+            if runFilter.pathPrefix or runFilter.maxDepth:
+                continue
+        elif not runFilter.keepsPath(funcpath):
+            continue
+        if runFilter.metrics:
+            record = {name: val for (name, val) in record.items() if name in runFilter.metrics or name == 'path'}
+        yield record
+
+def _getRunSlice(args, out):
+    # a subtree of a run: records under --root, at most --maxDepth levels
+    # below it, with only --metrics. .cali files are sliced record by record,
+    # so only the slice is kept; it is complete before anything is written, so
+    # a file the native reader cannot handle goes to cali-query instead of
+    # leaving a truncated document
+    root = args.root.strip('/') if args.root else None
+    maxDepth = args.maxDepth and (root.count('/') + 1 if root else 0) + args.maxDepth
+    runFilter = _RunFilter(args.metrics.split(',') if args.metrics else None, root, maxDepth)
+
+    if args.db and _isIngestedDB(args.db):
+        runs = dict(_iterIngestedRuns(args.db, [str(args.runId)], {}, runFilter))
+        if not runs:
+            raise KeyError('runs not found: {}'.format(args.runId))
+        (run,) = runs.values()
+        records = (dict(record, path=funcpath) for (funcpath, record) in run['Data'].items())
+        globals_ = run['Globals']
     else:
-        output = _cali_to_json(runId)
-        del output['attributes']
+        records = None
+        if not args.db and CONFIG['native_reader']:
+            globals_ = {}
+            try:
+                records = list(_sliceRecords(_iter_cali(args.runId, _CaliReader(), globals_), runFilter))
+            except CaliFormatError:
+                records = None
+        if records is None:
+            output = getRun(args.runId, args.db)
+            records = _sliceRecords(output['records'], runFilter)
+            globals_ = output['globals']
+
+    if args.format == 'ndjson':
+        for record in records:
+            _writeLine(out, {'record': record})
+        _writeLine(out, {'globals': globals_})
+    else:
+        out.write('{\n    "records": [')
+        sep = '\n        '
+        for record in records:
+            out.write(sep)
+            out.write(json.dumps(record))
+            sep = ',\n        '
+        out.write('\n    ],\n    "globals": ')
+        out.write(json.dumps(globals_))
+        out.write('\n}')
+
+def _getCaliRun(filepath):
+    output = _cali_to_json(filepath)
+    del output['attributes']
     return output
 
 
+def _hatchetLiteral(records, allRoots=False):
+    # build the tree in one pass: every path is attached to the node of its
+    # parent path (the path minus its last component), in record order.
+    # Returns the first root, or with allRoots every path without a parent
+    nodes = {}
+    for line in records:
+        funcpath = line.get('path', None)
+        if funcpath:
+            nodes[funcpath] = { 'name': funcpath.rsplit('/', 1)[-1]
+                              , 'metrics': {k: v for (k, v) in line.items() if k != 'path'}
+                              }
+    if not nodes:
+        return []
+
+    for (funcpath, node) in nodes.items():
+        parent = nodes.get(funcpath.rpartition('/')[0])
+        if parent is not None:
+            parent.setdefault('children', []).append(node)
+
+    if allRoots:
+        return [node for (funcpath, node) in nodes.items() if funcpath.rpartition('/')[0] not in nodes]
+    return [nodes[min(nodes.keys())]]
+
 def getHatchetLiteral(runId, db=None):
-    funcPathDict = {line.pop('path'): line for line in getRun(runId, db)['records'] if line.get('path', None)}
+    return _hatchetLiteral(getRun(runId, db)['records'])
 
-    def buildTree(nodeName):
-        node = {}
-        node['name'] = nodeName.split('/')[-1]
-        node['metrics'] = funcPathDict[nodeName]
-        childrenPaths = [childPath for childPath in funcPathDict.keys()
-                         if len(childPath.split('/')) == len(nodeName.split('/')) + 1 and childPath.startswith(nodeName)]
-        if childrenPaths:
-            node['children'] = [buildTree(childPath) for childPath in childrenPaths]
-        return node
+def getHatchetLiterals(runIds, db=None):
+    # {runId: literal} for many runs at once, e.g. for the hatchet notebooks
+    return {runId: _hatchetLiteral(run['records']) for (runId, run) in getRuns(runIds, db).items()}
 
-    return [buildTree(min(funcPathDict.keys()))]
 
+# the operations of the front-end, the only ones serve answers: none of them
+# writes to a path of the request's choosing
+_SERVE_COMMANDS = ('getData', 'getRun', 'getRuns', 'memory', 'jupyter', 'multi_jupyter')
 
-if __name__ == "__main__":
+def _serveToken(tokenFile):
+    # the token TCP requests must send as 'Authorization: Bearer <token>',
+    # generated into a file only the user can read if there is none yet
+    import secrets
+    try:
+        with open(tokenFile) as f:
+            token = f.read().strip()
+        if token:
+            return token
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(tokenFile), mode=0o700, exist_ok=True)
+    token = secrets.token_urlsafe(32)
+    fd = os.open(tokenFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + '\n')
+    return token
+
+class _ChunkedOutput:
+    # the out of a command run by serve: the response starts on the first chunk
+    # of output and is sent with chunked transfer encoding while the command runs
+    def __init__(self, handler, chunkSize=1 << 16):
+        self.handler = handler
+        self.chunkSize = chunkSize
+        self.buffer = []
+        self.size = 0
+        self.started = False
+
+    def write(self, s):
+        self.buffer.append(s)
+        self.size += len(s)
+        if self.size >= self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.start()
+        data = ''.join(self.buffer).encode('utf-8')
+        self.buffer = []
+        self.size = 0
+        self.handler.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.handler.send_response(200)
+            self.handler.send_header('Content-Type', 'application/json')
+            self.handler.send_header('Transfer-Encoding', 'chunked')
+            self.handler.end_headers()
+
+    def close(self):
+        self.flush()
+        self.start()
+        self.handler.wfile.write(b'0\r\n\r\n')
+
+def serve(args, out=sys.stdout):
+    # answer requests from the front-end in a long-running process.  A request is
+    # a POST whose body is the JSON list of arguments that would otherwise be
+    # passed to spot.py, e.g. ["getData", "/path/to/dataset", "{}"]; the response
+    # body is what spot.py would have printed, streamed as it is produced: an
+    # error after the first chunk is sent ends the body with an {"error": ..} line.
+    # Listens on a unix socket only the user can connect to, or with --port on
+    # localhost for requests with the token
+    import http.server, socketserver, traceback, signal, hmac, tempfile
+    global _SERVING
+    _SERVING = True
+    _workerPool()
+    parser = _buildParser()
+    token = _serveToken(os.path.expanduser(args.token_file)) if args.port else None
+    socketPath = None if args.port else (args.socket or os.path.join(os.getenv('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                                                                     'spot-{}.sock'.format(getpass.getuser())))
+
+    class RequestHandler(http.server.BaseHTTPRequestHandler):
+        # chunked responses need HTTP/1.1
+        protocol_version = 'HTTP/1.1'
+
+        def address_string(self):
+            return socketPath or self.client_address[0]
+
+        def do_POST(self):
+            out = _ChunkedOutput(self)
+            if token is not None and not hmac.compare_digest(self.headers.get('Authorization', ''), 'Bearer ' + token):
+                # the body is not read, so the connection cannot be reused
+                self.close_connection = True
+                self.reply(401, 'unauthorized\n')
+                return
+            try:
+                argv = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                reqArgs = parser.parse_args([str(arg) for arg in argv])
+                if reqArgs.sub_name not in _SERVE_COMMANDS or reqArgs.config or reqArgs.profile_log or reqArgs.cprofile:
+                    raise ValueError('unsupported request')
+                _runCommand(reqArgs, out)
+                out.close()
+            except SystemExit:
+                self.fail(out, 400, 'invalid arguments\n')
+            except ValueError as e:
+                self.fail(out, 400, 'invalid request: {}\n'.format(e))
+            except Exception:
+                self.fail(out, 500, traceback.format_exc())
+
+        def fail(self, out, status, message):
+            if not out.started:
+                self.reply(status, message)
+                return
+            out.buffer = []
+            out.write('\n' + json.dumps({'error': message}) + '\n')
+            out.close()
+
+        def reply(self, status, body):
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json' if status == 200 else 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    if socketPath:
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+        if os.path.exists(socketPath):
+            os.unlink(socketPath)
+        # created without group or other permissions, not chmod'ed after the fact
+        umask = os.umask(0o177)
+        try:
+            server = Server(socketPath, RequestHandler)
+        finally:
+            os.umask(umask)
+    else:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), RequestHandler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if socketPath:
+            os.unlink(socketPath)
 
-    # argparse
+
+def _buildParser():
     parser = argparse.ArgumentParser(description="utility to access data from .cali files/directory or database")
     parser.add_argument("--config", help="filepath to yaml config file")
     parser.add_argument("--container", action="store_true", help="use if running container version of spot")
     parser.add_argument("--ci_testing", help="get notebook path for CI tests", action="store_true")
+    parser.add_argument("--profile", action="store_true", help="report time, counts and bytes per phase and per file on stderr")
+    parser.add_argument("--profile_log", help="append the --profile report to this file instead of stderr")
+    parser.add_argument("--cprofile", help="with --profile, also dump cProfile stats to this file")
     subparsers = parser.add_subparsers(dest="sub_name")
 
     memory_sub = subparsers.add_parser("memory")
-    memory_sub.add_argument("cali_filepath", help="create a notebook to check out a sweet cali file")
+    memory_sub.add_argument("cali_filepath", nargs="+", help="timeseries cali file(s); several files are returned aligned")
     #memory_sub.add_argument("count", help="enter memory count")
+    memory_sub.add_argument("--x", default="block", help="attribute on the x axis")
+    memory_sub.add_argument("--start", type=float, help="drop records before this x")
+    memory_sub.add_argument("--end", type=float, help="drop records after this x")
+    memory_sub.add_argument("--points", type=int, help="downsample to about this many points (buckets for several files)")
+    memory_sub.add_argument("--method", choices=["lttb", "minmax"], default="lttb", help="downsampling method for a single file")
+    memory_sub.add_argument("--metric", help="metric whose shape downsampling preserves")
     memory_sub.set_defaults(func=memoryGraph)
 
     jupyter_sub = subparsers.add_parser("jupyter")
@@ -524,17 +3071,88 @@ if __name__ == "__main__":
 
     getData_sub = subparsers.add_parser("getData")
     getData_sub.add_argument("dataSetKey",  help="directory path of files, or yaml config file")
-    getData_sub.add_argument("cachedRunCtimes",  help="list of subpaths with timestamps")
+    getData_sub.add_argument("cachedRunCtimes",  help="json map of subpaths with timestamps, or {\"dirDigests\": map of directories to the digests of the last output} for directories; - to read it from stdin, @path from a file")
     getData_sub.add_argument("--lastRead",  help="posix time with decimal for directories, run number for database")
+    getData_sub.add_argument("--format", choices=["json", "ndjson", "columnar"], default="json",
+                             help="ndjson: stream one line per run, then the metadata. columnar: interned paths and per-metric arrays")
+    getData_sub.add_argument("--metrics",  help="comma separated metrics to return (default: all)")
+    getData_sub.add_argument("--pathPrefix",  help="only return call paths under this one, e.g. main/solve")
+    getData_sub.add_argument("--maxDepth", type=int, help="only return call paths with at most this many components")
+    getData_sub.add_argument("--where", action="append", help="only return runs whose globals match, e.g. commit=abc or launchdate>=1573600000; repeatable")
+    getData_sub.add_argument("--summary", action="store_true", help="only return the globals of each run, without reading the call path data")
+    getData_sub.add_argument("--runKeys", help="json list of runs to return, e.g. to fetch the data of runs from a --summary in batches")
+    getData_sub.add_argument("--shard", help="i/n: only read partition i of n of the runs (by crc32 of the run key, or run number modulo n for databases); combine the outputs with merge")
     getData_sub.set_defaults(func=getData)
 
+    merge_sub = subparsers.add_parser("merge")
+    merge_sub.add_argument("shardOutputs", nargs="+", help="json or ndjson outputs of getData --shard")
+    merge_sub.add_argument("--format", choices=["json", "ndjson", "columnar"], default="json", help="as for getData")
+    merge_sub.set_defaults(func=merge)
+
+    getAggregate_sub = subparsers.add_parser("getAggregate")
+    getAggregate_sub.add_argument("dataSetKey",  help="directory path of files, yaml config file, or matrix store written by export")
+    getAggregate_sub.add_argument("--groupBy",  help="comma separated globals to group runs by; global:width buckets numeric ones, e.g. launchdate:86400")
+    getAggregate_sub.add_argument("--metrics",  help="comma separated metrics to aggregate (default: all numeric ones)")
+    getAggregate_sub.add_argument("--percentiles", default="25,50,75,90", help="comma separated percentiles to report")
+    getAggregate_sub.set_defaults(func=getAggregate)
+
+    ingest_sub = subparsers.add_parser("ingest")
+    ingest_sub.add_argument("directory",  help="directory of .cali files")
+    ingest_sub.add_argument("db",  help="sqlite DB to load the runs into; getData and getRun read it like a directory")
+    ingest_sub.add_argument("--batchSize", type=int, default=200, help="runs per transaction")
+    ingest_sub.set_defaults(func=ingest)
+
+    export_sub = subparsers.add_parser("export")
+    export_sub.add_argument("dataSetKey",  help="directory path of files, or yaml config file")
+    export_sub.add_argument("storeDir",  help="directory of the matrix store: one runs x paths .npy per metric that numpy can memory-map; exporting again adds the new runs")
+    export_sub.add_argument("--dtype", choices=["float64", "float32"], default="float64", help="dtype of the matrices of a new store")
+    export_sub.add_argument("--metrics",  help="comma separated metrics to export (default: all numeric ones)")
+    export_sub.add_argument("--pathPrefix",  help="only export call paths under this one")
+    export_sub.add_argument("--maxDepth", type=int, help="only export call paths with at most this many components")
+    export_sub.add_argument("--where", action="append", help="only export runs whose globals match; repeatable")
+    export_sub.add_argument("--batchSize", type=int, default=500, help="runs written to the matrices at a time")
+    export_sub.set_defaults(func=export)
+
     getRun_sub = subparsers.add_parser("getRun")
     getRun_sub.add_argument("runId",  help="filepath or db run number")
     getRun_sub.add_argument("--db",  help="yaml config file, or sqlite DB")
-    getRun_sub.set_defaults(func=lambda args: json.dump(getRun(args.runId, args.db), sys.stdout, indent=4))
+    getRun_sub.add_argument("--format", choices=["json", "ndjson"], default="json", help="ndjson: stream one line per record, then the globals")
+    getRun_sub.add_argument("--root",  help="only return the records of this call path and below, e.g. main/solve")
+    getRun_sub.add_argument("--maxDepth", type=int, help="only return call paths at most this many levels below --root (or the top)")
+    getRun_sub.add_argument("--metrics",  help="comma separated metrics to return (default: all)")
+    getRun_sub.set_defaults(func=getRunCmd)
+
+    getDiff_sub = subparsers.add_parser("getDiff")
+    getDiff_sub.add_argument("dataSetKey",  help="directory path of files, or yaml config file")
+    getDiff_sub.add_argument("--runA", action="append", help="run of the first side; repeatable")
+    getDiff_sub.add_argument("--runB", action="append", help="run of the second side; repeatable")
+    getDiff_sub.add_argument("--whereA", action="append", help="select the first side's runs by their globals, e.g. commit=abc; repeatable")
+    getDiff_sub.add_argument("--whereB", action="append", help="select the second side's runs by their globals; repeatable")
+    getDiff_sub.add_argument("--metrics",  help="comma separated metrics to compare (default: all numeric ones)")
+    getDiff_sub.add_argument("--top", type=int, default=100, help="return the paths with the largest deltas per metric (0: all)")
+    getDiff_sub.set_defaults(func=getDiff)
+
+    getRuns_sub = subparsers.add_parser("getRuns")
+    getRuns_sub.add_argument("runIds",  help="json list of filepaths or db run numbers")
+    getRuns_sub.add_argument("--db",  help="yaml config file, or sqlite DB")
+    getRuns_sub.add_argument("--format", choices=["json", "ndjson"], default="json", help="ndjson: stream one line per run")
+    getRuns_sub.set_defaults(func=getRunsCmd)
+
+    serve_sub = subparsers.add_parser("serve")
+    serve_sub.add_argument("--socket", help="unix socket to listen on, only accessible to the user (default: spot-<user>.sock in $XDG_RUNTIME_DIR or the temp directory)")
+    serve_sub.add_argument("--port", type=int, help="listen on this localhost port instead; requests must send 'Authorization: Bearer <token>'")
+    serve_sub.add_argument("--token_file", default="~/.config/spot/serve-token", help="file holding the token for --port, created if missing")
+    serve_sub.set_defaults(func=serve)
+
+    return parser
+
 
+if __name__ == "__main__":
+
+    # argparse
+    parser = _buildParser()
     args = parser.parse_args()
     if args.config:
         import yaml
         CONFIG.update(yaml.load(open(args.config), Loader=yaml.FullLoader))
-    args.func(args)
+    _runCommand(args)